@@ -0,0 +1,455 @@
+# BMS to RPP benchmark
+# Copyright (C) 2020 shockdude
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import time
+import json
+import random
+import platform
+import tempfile
+import tracemalloc
+import wave
+import struct
+import subprocess
+
+# max rss is only available on unix
+try:
+	import resource
+except ImportError:
+	resource = None
+
+import bms_to_rpp
+import chunkedogg_extract
+
+BASE36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+MAX_KEYSOUNDS = 36 * 36 - 1
+
+# slots per measure of generated note lines
+NOTE_RESOLUTION = 16
+# slots per measure of generated duplicate lines, coprime-ish with NOTE_RESOLUTION
+DUPLICATE_RESOLUTIONS = (12, 24, 7, 48)
+
+# channels that get generated notes
+BMS_NOTE_CHANNELS = ("11", "12", "13", "14", "15", "16", "18", "19",
+					"21", "22", "23", "24", "25", "26", "28", "29")
+BMS_LONG_NOTE_CHANNELS = ("51", "52", "53", "54", "55", "56", "58", "59",
+						"61", "62", "63", "64", "65", "66", "68", "69")
+DTX_NOTE_CHANNELS = ("11", "12", "13", "14", "15", "16", "17", "18", "19", "1A",
+					"20", "21", "22", "23", "24", "A0", "A1", "A2", "A3", "A4",
+					"61", "62", "63", "64", "65")
+
+# default generator knobs
+DEFAULT_PARAMS = {
+	"measures": 999,
+	"notes": 64,
+	"bpm_changes": 1,
+	"stops": 1,
+	"wavs": MAX_KEYSOUNDS,
+	"duplicates": 2,
+	"long_notes": 2,
+	"bgm": 2,
+	"seed": 1,
+}
+
+def usage():
+	print("BMS to RPP benchmark")
+	print("Generates synthetic charts, times each phase of the conversion & the startup, & prints the results as JSON")
+	print("Usage: {} [options]".format(sys.argv[0]))
+	print("Options:")
+	print("  --format F       bms, dtx or all (default: all)")
+	print("  --measures N     number of measures, at most 1000 (default: {})".format(DEFAULT_PARAMS["measures"]))
+	print("  --notes N        notes per measure (default: {})".format(DEFAULT_PARAMS["notes"]))
+	print("  --bpm-changes N  bpm changes per measure, on channels 03 & 08 (default: {})".format(DEFAULT_PARAMS["bpm_changes"]))
+	print("  --stops N        #STOPs per measure, bms only (default: {})".format(DEFAULT_PARAMS["stops"]))
+	print("  --wavs N         number of #WAV keysounds, at most {} (default: {})".format(MAX_KEYSOUNDS, DEFAULT_PARAMS["wavs"]))
+	print("  --duplicates N   duplicate channel lines per measure (default: {})".format(DEFAULT_PARAMS["duplicates"]))
+	print("  --long-notes N   long notes per measure on channels 5x/6x, bms only (default: {})".format(DEFAULT_PARAMS["long_notes"]))
+	print("  --bgm N          bgm lines per measure (default: {})".format(DEFAULT_PARAMS["bgm"]))
+	print("  --seed N         random seed (default: {})".format(DEFAULT_PARAMS["seed"]))
+	print("  --repeat N       convert each chart N times & keep the best time of each phase (default: 3)")
+	print("  --extract-mb N   also time chunkedogg_extract on a N MB chunked vorbis wav (default: 0, off)")
+	print("  --startup-budget MS  exit with an error if importing bms_to_rpp takes longer than MS milliseconds")
+	print("  --out FILE       also write the results to FILE")
+	sys.exit(1)
+
+# keysound index in base 36, e.g. 71 --> "1Z"
+def keysound_index(n):
+	return BASE36[n // 36] + BASE36[n % 36]
+
+# write a short silent wav
+def write_wav(wav_file, frames):
+	with wave.open(wav_file, "wb") as wav:
+		wav.setnchannels(1)
+		wav.setsampwidth(2)
+		wav.setframerate(44100)
+		wav.writeframes(b"\x00\x00" * frames)
+
+# number of #WAV keysounds in a generated chart
+def num_keysounds(params):
+	return max(1, min(params["wavs"], MAX_KEYSOUNDS))
+
+# build a channel line from a dict of slot to value
+def channel_line(measure, channel, sep, resolution, notes):
+	data = "".join(notes.get(slot, "00") for slot in range(resolution))
+	return "#{:03d}{}{}{}".format(measure, channel, sep, data)
+
+# write a synthetic chart & its keysounds into chart_dir
+# returns the chart filename
+def write_chart(chart_dir, chart_format, params):
+	rand = random.Random(params["seed"])
+	dtx = chart_format == "dtx"
+	if dtx:
+		chart_file = os.path.join(chart_dir, "chart" + bms_to_rpp.DTX_EXT)
+		sep = ": "
+		note_channels = DTX_NOTE_CHANNELS
+		long_note_channels = ()
+	else:
+		chart_file = os.path.join(chart_dir, "chart.bms")
+		sep = " "
+		note_channels = BMS_NOTE_CHANNELS
+		long_note_channels = BMS_LONG_NOTE_CHANNELS
+	def random_keysound():
+		return keysound_index(rand.randint(1, num_keysounds(params)))
+
+	lines = ["#TITLE benchmark", "#BPM{}150".format(sep), "#VOLWAV{}100".format(sep), "#LNTYPE{}1".format(sep)]
+	for i in range(1, num_keysounds(params) + 1):
+		index = keysound_index(i)
+		wav_file = "{}.wav".format(index)
+		write_wav(os.path.join(chart_dir, wav_file), rand.randint(100, 20000))
+		lines.append("#WAV{}{}{}".format(index, sep, wav_file))
+		if dtx:
+			lines.append("#VOLUME{}{}{}".format(index, sep, rand.randint(10, 100)))
+			lines.append("#PAN{}{}{}".format(index, sep, rand.randint(-100, 100)))
+	for i in range(1, 10):
+		index = keysound_index(i)
+		lines.append("#BPM{}{}{}".format(index, sep, rand.choice(("90", "133.5", "200", "75.25"))))
+		if not dtx:
+			lines.append("#STOP{}{}{}".format(index, sep, rand.choice((24, 48, 96, 192))))
+
+	for measure in range(min(params["measures"], 1000)):
+		if measure % 16 == 15:
+			lines.append("#{:03d}02{}0.75".format(measure, sep))
+
+		# bpm changes, alternating between plain (03) & extended (08) bpms
+		bpm_notes = {}
+		extbpm_notes = {}
+		for slot in rand.sample(range(NOTE_RESOLUTION), min(params["bpm_changes"], NOTE_RESOLUTION)):
+			if rand.random() < 0.5:
+				bpm_notes[slot] = "{:02X}".format(rand.randint(60, 250))
+			else:
+				extbpm_notes[slot] = keysound_index(rand.randint(1, 9))
+		if len(bpm_notes) > 0:
+			lines.append(channel_line(measure, bms_to_rpp.BPM_CHANNEL, sep, NOTE_RESOLUTION, bpm_notes))
+		if len(extbpm_notes) > 0:
+			lines.append(channel_line(measure, bms_to_rpp.EXTBPM_CHANNEL, sep, NOTE_RESOLUTION, extbpm_notes))
+
+		# stops
+		if not dtx and params["stops"] > 0:
+			stop_notes = {}
+			for slot in rand.sample(range(NOTE_RESOLUTION), min(params["stops"], NOTE_RESOLUTION)):
+				stop_notes[slot] = keysound_index(rand.randint(1, 9))
+			lines.append(channel_line(measure, bms_to_rpp.STOP_CHANNEL, sep, NOTE_RESOLUTION, stop_notes))
+
+		# bgm
+		for i in range(params["bgm"]):
+			bgm_notes = {slot: random_keysound() for slot in range(0, NOTE_RESOLUTION, 4) if rand.random() < 0.5}
+			lines.append(channel_line(measure, "01", sep, NOTE_RESOLUTION, bgm_notes))
+
+		# notes spread over random channels & slots
+		channel_notes = {}
+		num_slots = len(note_channels) * NOTE_RESOLUTION
+		for slot in rand.sample(range(num_slots), min(params["notes"], num_slots)):
+			channel = note_channels[slot // NOTE_RESOLUTION]
+			if channel not in channel_notes:
+				channel_notes[channel] = {}
+			channel_notes[channel][slot % NOTE_RESOLUTION] = random_keysound()
+		for channel in note_channels:
+			if channel in channel_notes:
+				lines.append(channel_line(measure, channel, sep, NOTE_RESOLUTION, channel_notes[channel]))
+
+		# long notes, a start & an end with the same keysound
+		for channel in rand.sample(long_note_channels, min(params["long_notes"], len(long_note_channels))):
+			keysound = random_keysound()
+			start = rand.randrange(NOTE_RESOLUTION - 1)
+			end = rand.randrange(start + 1, NOTE_RESOLUTION)
+			lines.append(channel_line(measure, channel, sep, NOTE_RESOLUTION, {start: keysound, end: keysound}))
+
+		# duplicate lines of note channels at other resolutions, merged by the parser
+		for i in range(params["duplicates"]):
+			resolution = rand.choice(DUPLICATE_RESOLUTIONS)
+			notes = {rand.randrange(resolution): random_keysound()}
+			lines.append(channel_line(measure, rand.choice(note_channels), sep, resolution, notes))
+
+	with open(chart_file, "w", encoding="shift_jis") as chart:
+		chart.write("\n".join(lines))
+		chart.write("\n")
+	return chart_file
+
+# convert a chart without the keysound & compiled chart caches
+# returns the profile of the conversion, with the time of each phase
+def profile_conversion(chart_file):
+	converter = bms_to_rpp.ChartConverter(verbose=False)
+	converter.convert(chart_file)
+	return converter.get_profile()
+
+# convert a chart with a compiled chart cache, saving it to the cache if it isn't there yet
+# returns the wall time of the conversion
+def time_cached_conversion(chart_file, chart_cache_dir):
+	converter = bms_to_rpp.ChartConverter(verbose=False, chart_cache_dir=chart_cache_dir)
+	start = time.perf_counter()
+	converter.convert(chart_file)
+	return time.perf_counter() - start
+
+# benchmark one chart format, keeping the best time of each phase over all repeats
+def run_benchmark(chart_format, params, repeat):
+	with tempfile.TemporaryDirectory() as chart_dir:
+		start = time.perf_counter()
+		chart_file = write_chart(chart_dir, chart_format, params)
+		generate_seconds = time.perf_counter() - start
+		chart_bytes = os.path.getsize(chart_file)
+
+		best_wall = {}
+		best_cpu = {}
+		for i in range(repeat):
+			profile = profile_conversion(chart_file)
+			for name, phase in profile["phases"].items():
+				if name not in best_wall or phase["wall"] < best_wall[name]:
+					best_wall[name] = phase["wall"]
+					best_cpu[name] = phase["cpu"]
+		# peak memory is traced in a separate run, tracing slows everything down
+		tracemalloc.start()
+		profile_conversion(chart_file)
+		peak_memory = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+		# re-export from the compiled chart, saved by the first conversion
+		chart_cache_dir = os.path.join(chart_dir, bms_to_rpp.CHART_CACHE_DIR)
+		time_cached_conversion(chart_file, chart_cache_dir)
+		cached_seconds = min(time_cached_conversion(chart_file, chart_cache_dir) for i in range(repeat))
+	total = sum(best_wall.values())
+	counters = profile["counters"]
+
+	return {
+		"format": chart_format,
+		"chart_bytes": chart_bytes,
+		"keysounds": num_keysounds(params),
+		"counters": counters,
+		"generate_seconds": generate_seconds,
+		"phase_seconds": best_wall,
+		"phase_cpu_seconds": best_cpu,
+		"total_seconds": total,
+		"lines_per_second": counters["lines"] / best_wall["read"],
+		"items_per_second": counters["items"] / total,
+		"cached_seconds": cached_seconds,
+		"peak_memory_bytes": peak_memory,
+	}
+
+# write a synthetic chunked vorbis wav of about size bytes: ogg pages of random data
+# in a wav data chunk, every fourth page being a padding page that gets skipped
+def write_chunked_ogg(wav_file, size, seed=1):
+	rand = random.Random(seed)
+	segment_table = bytes([255] * 16)
+	body = bytes(rand.getrandbits(8) for i in range(sum(segment_table)))
+	with open(wav_file, "wb") as wav:
+		wav.write(b"RIFF\x00\x00\x00\x00WAVEfmt \x10\x00\x00\x00" + bytes(16) + b"data\x00\x00\x00\x00")
+		written = 0
+		sequence = 0
+		while written < size:
+			serial = chunkedogg_extract.SKIPPED_SERIAL if sequence % 4 == 3 else 1
+			page = bytearray(chunkedogg_extract.OGG_PAGE_HEADER.pack(chunkedogg_extract.OGG_MAGIC, 0, 0, sequence * 1024, serial, sequence, 0, len(segment_table)))
+			page += segment_table + body
+			struct.pack_into("<I", page, chunkedogg_extract.OGG_CRC_OFFSET, chunkedogg_extract.ogg_page_crc(page))
+			wav.write(page)
+			written += len(page)
+			sequence += 1
+
+# time extracting the ogg out of a chunked vorbis wav, with & without checking crcs
+def run_extract_benchmark(size_mb, repeat):
+	with tempfile.TemporaryDirectory() as extract_dir:
+		wav_file = os.path.join(extract_dir, "chunked.wav")
+		ogg_file = os.path.join(extract_dir, "chunked.ogg")
+		write_chunked_ogg(wav_file, size_mb * 1000000)
+		wav_size = os.path.getsize(wav_file)
+		results = {"wav_bytes": wav_size}
+		for check_crc in (False, True):
+			best = None
+			for i in range(repeat):
+				start = time.perf_counter()
+				num_written, num_skipped, num_bad_crc, num_bytes = chunkedogg_extract.extract_file(wav_file, ogg_file, check_crc)
+				elapsed = time.perf_counter() - start
+				if best == None or elapsed < best:
+					best = elapsed
+			results["check_crc" if check_crc else "no_crc"] = {
+				"seconds": best,
+				"mb_per_second": wav_size / 1e6 / best,
+				"pages_written": num_written,
+				"pages_skipped": num_skipped,
+				"pages_bad_crc": num_bad_crc,
+				"ogg_bytes": num_bytes,
+			}
+	return results
+
+# size of the chart converted by the startup benchmark
+STARTUP_CHART_PARAMS = dict(DEFAULT_PARAMS, measures=8, wavs=32)
+# slow modules that a small wav-only chart shouldn't need
+STARTUP_HEAVY_MODULES = ("pydub", "numpy", "multiprocessing", "http.server", "subprocess")
+# number of modules listed in the startup results
+STARTUP_MODULES = 10
+
+# run python with -X importtime, returns the wall time & a list of the imported modules
+# as (name, nesting depth, cumulative import time in seconds), each module after the modules it imported
+def run_importtime(args, env=None):
+	start = time.perf_counter()
+	result = subprocess.run([sys.executable, "-X", "importtime"] + args, stdout=subprocess.DEVNULL,
+		stderr=subprocess.PIPE, env=env, cwd=os.path.dirname(os.path.abspath(bms_to_rpp.__file__)), universal_newlines=True)
+	elapsed = time.perf_counter() - start
+	if result.returncode != 0:
+		raise RuntimeError("python {} failed: {}".format(" ".join(args), result.stderr[-1000:]))
+	modules = []
+	for line in result.stderr.splitlines():
+		# lines of "import time: self [us] | cumulative | imported package", after a header line
+		# nested imports are indented by 2 spaces per level
+		if line.startswith("import time:"):
+			self_us, cumulative_us, name = line[len("import time:"):].split("|")
+			if cumulative_us.strip().isdigit():
+				modules.append((name.strip(), (len(name) - len(name.lstrip()) - 1) // 2, int(cumulative_us) / 1e6))
+	return elapsed, modules
+
+# get the cumulative import time of a module & the modules it imported directly, from run_importtime()
+def get_import_times(modules, module_name):
+	for i, (name, depth, seconds) in enumerate(modules):
+		if name == module_name:
+			break
+	else:
+		return None, {}
+	# the modules imported by this one are listed right before it, one level deeper
+	imported = {}
+	for other_name, other_depth, other_seconds in reversed(modules[:i]):
+		if other_depth <= depth:
+			break
+		if other_depth == depth + 1:
+			imported[other_name] = other_seconds
+	return seconds, imported
+
+# time starting fresh interpreters, keeping the best run:
+# importing bms_to_rpp, & converting a small wav-only chart from the command line
+# also lists the slowest modules imported by bms_to_rpp & the heavy modules the small chart needed
+def run_startup_benchmark(repeat):
+	best = None
+	for i in range(repeat):
+		elapsed, modules = run_importtime(["-c", "import bms_to_rpp"])
+		import_seconds, imported = get_import_times(modules, "bms_to_rpp")
+		if best == None or import_seconds < best[1]:
+			best = (elapsed, import_seconds, imported)
+	elapsed, import_seconds, imported = best
+	slowest = sorted(imported, key=imported.get, reverse=True)[:STARTUP_MODULES]
+	results = {
+		"import_seconds": import_seconds,
+		"process_seconds": elapsed,
+		"slowest_modules": {name: imported[name] for name in slowest},
+	}
+
+	with tempfile.TemporaryDirectory() as chart_dir:
+		chart_file = write_chart(chart_dir, "bms", STARTUP_CHART_PARAMS)
+		env = dict(os.environ)
+		env[bms_to_rpp.CACHE_DIR_ENV] = os.path.join(chart_dir, "cache")
+		best = None
+		for i in range(repeat):
+			elapsed, modules = run_importtime(["bms_to_rpp.py", chart_file], env)
+			if best == None or elapsed < best[0]:
+				best = (elapsed, modules)
+		elapsed, modules = best
+		results["small_chart"] = {
+			"seconds": elapsed,
+			"heavy_modules": [name for name in STARTUP_HEAVY_MODULES if name in set(module[0] for module in modules)],
+		}
+	return results
+
+def get_option_value(arg, argv):
+	if "=" in arg:
+		return arg.split("=", 1)[1]
+	if len(argv) == 0:
+		usage()
+	return argv.pop(0)
+
+def main():
+	params = dict(DEFAULT_PARAMS)
+	chart_formats = ["bms", "dtx"]
+	repeat = 3
+	extract_mb = 0
+	startup_budget = None
+	out_file = None
+	argv = sys.argv[1:]
+	while len(argv) > 0:
+		arg = argv.pop(0)
+		option = arg.split("=", 1)[0]
+		param = option[2:].replace("-", "_")
+		if param in params:
+			try:
+				params[param] = int(get_option_value(arg, argv))
+			except ValueError:
+				usage()
+		elif option == "--format":
+			value = get_option_value(arg, argv)
+			if value == "all":
+				chart_formats = ["bms", "dtx"]
+			elif value in ("bms", "dtx"):
+				chart_formats = [value]
+			else:
+				usage()
+		elif option == "--repeat":
+			repeat = max(1, int(get_option_value(arg, argv)))
+		elif option == "--extract-mb":
+			extract_mb = max(0, int(get_option_value(arg, argv)))
+		elif option == "--startup-budget":
+			try:
+				startup_budget = float(get_option_value(arg, argv)) / 1000
+			except ValueError:
+				usage()
+		elif option == "--out":
+			out_file = get_option_value(arg, argv)
+		else:
+			usage()
+
+	report = {
+		"version": bms_to_rpp.VERSION,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"numpy": bms_to_rpp.has_numpy(),
+		"params": params,
+		"repeat": repeat,
+		"results": [run_benchmark(chart_format, params, repeat) for chart_format in chart_formats],
+		"startup": run_startup_benchmark(repeat),
+	}
+	if extract_mb > 0:
+		report["extract"] = run_extract_benchmark(extract_mb, repeat)
+	if startup_budget != None:
+		report["startup"]["budget_seconds"] = startup_budget
+	if resource != None:
+		# kilobytes on linux, bytes on macos
+		report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	print(json.dumps(report, indent=2))
+	if out_file != None:
+		with open(out_file, "w") as out:
+			json.dump(report, out, indent=2)
+	if startup_budget != None and report["startup"]["import_seconds"] > startup_budget:
+		print("Importing bms_to_rpp took {:.1f} ms, over the budget of {:.1f} ms".format(
+			report["startup"]["import_seconds"] * 1000, startup_budget * 1000), file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
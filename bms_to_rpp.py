@@ -21,21 +21,98 @@ import sys
 import os
 import time
 import re
+import gzip
+import json
+import locale
 import math
-from pydub import AudioSegment
+import bisect
+import struct
+import threading
+import wave
+import queue
+import stat
+import importlib.util
+from array import array
+from collections import OrderedDict
+
+import chunkedogg_extract
+
+# heavy modules are imported on first use, so starting up stays fast
+# & charts with only wav, ogg & mp3 keysounds never import pydub
+# modules only some options need, e.g. sqlite3 for the keysound cache, are imported where they're used
+
+# pydub's AudioSegment, imported by import_pydub()
+# only needed for other keysound formats, rendering & flac output, importing it looks for ffmpeg
+AudioSegment = None
+
+def import_pydub():
+	global AudioSegment
+	if AudioSegment == None:
+		from pydub import AudioSegment
+	return AudioSegment
+
+# numpy, imported by import_numpy() if installed
+# optional, vectorizes note timing for large charts, required for rendering
+numpy = None
+# importing numpy takes about as long as timing this many notes without it
+NUMPY_MIN_NOTES = 50000
+
+# import numpy, returns None if it isn't installed
+def import_numpy():
+	global numpy
+	if numpy == None and has_numpy():
+		import numpy
+	return numpy
+
+def has_numpy():
+	return numpy != None or importlib.util.find_spec("numpy") != None
 
 def usage():
 	print("BMS to RPP {}".format(VERSION))
 	print("Convert a BMS or DTX chart into a playable REAPER project")
-	print("WAV keysounds recommended, OGG/MP3 keysounds require ffmpeg/avconv and are slow to parse.")
-	print("Usage: {} chart_file.bms [output_filename.rpp]".format(sys.argv[0]))
+	print("WAV/OGG/MP3 keysounds supported, other formats require ffmpeg/avconv and are slow to parse.")
+	print("Usage: {} [options] chart_file.bms [output_filename.rpp]".format(sys.argv[0]))
+	print("       output_filename can end in .rpp.gz for a gzipped project, or be - for stdout")
+	print("       {} [options] --batch chart_directory".format(sys.argv[0]))
+	print("Options:")
+	print("  --no-cache     don't read or write the keysound metadata & compiled chart caches")
+	print("  --clear-cache  empty the keysound metadata & compiled chart caches first")
+	print("  --exts LIST    keysound extensions to look for, in order of priority (default: {})".format(",".join(ext[1:] for ext in KEYSOUND_EXTS)))
+	print("  --jobs N       probe N keysounds or convert N charts in parallel (default: number of CPUs)")
+	print("  --batch DIR    convert every chart in a directory tree")
+	print("  --force        with --batch, also convert charts whose rpp is up to date")
+	print("  --report FILE  with --batch, write the report to FILE (default: DIR/{})".format(BATCH_REPORT_FILE))
+	print("  --watch        convert again whenever the chart is saved, until interrupted")
+	print("  --serve ADDR   run a conversion server on a port, host:port or unix socket path, with --jobs workers")
+	print("  --probe-unused also probe keysounds that no note refers to")
+	print("  --render FILE  also mix the chart down to a wav or flac (flac requires ffmpeg/avconv), requires numpy")
+	print("  --profile[=F]  print the time of each phase & counters as a table or json (F: table, json)")
+	print("                 with --batch, for the {} slowest charts (table) or every chart (json)".format(BATCH_PROFILE_CHARTS))
 	time.sleep(3)
 	sys.exit(1)
 
+# phases of a conversion, in order
+# keysounds are probed in the background from the read phase on, probe only waits for what's left
+# a chart found in the chart cache skips from read, which loads it, to write
+PHASES = ("read", "timing", "probe", "trim", "cache", "write", "render")
+# --profile output formats
+PROFILE_FORMATS = ("table", "json")
+
+# seconds between checks of the chart in --watch mode
+WATCH_INTERVAL = 0.25
+# a chart that can't be converted
+class ConversionError(Exception):
+	pass
+
 WAV_EXT = ".wav"
 OGG_EXT = ".ogg"
 MP3_EXT = ".mp3"
 RPP_EXT = ".rpp"
+GZIP_EXT = ".gz"
+# output filename for writing the rpp to stdout
+RPP_STDOUT = "-"
+# rpp text is encoded & written in blocks of about this many characters
+RPP_WRITE_BLOCK_SIZE = 1 << 20
 
 BMS_EXTS = (".bms", ".bme", ".bml", ".pms")
 DTX_EXT = ".dtx"
@@ -63,577 +140,2059 @@ MEASURE_LEN_CHANNEL = "02"
 BPM_CHANNEL = "03"
 EXTBPM_CHANNEL = "08"
 STOP_CHANNEL = "09"
+# playable channels & channels with a data array, as sets for fast lookups
+BMS_PLAYABLE_CHANNEL_SET = frozenset(BMS_PLAYABLE_CHANNELS)
+DTX_PLAYABLE_CHANNEL_SET = frozenset(DTX_PLAYABLE_CHANNELS)
+BMS_DATA_CHANNELS = frozenset(BMS_PLAYABLE_CHANNELS + (BPM_CHANNEL, EXTBPM_CHANNEL, STOP_CHANNEL))
+DTX_DATA_CHANNELS = frozenset(DTX_PLAYABLE_CHANNELS + (BPM_CHANNEL, EXTBPM_CHANNEL, STOP_CHANNEL))
+# channels that change the time of every later measure
+TEMPO_CHANNELS = frozenset((MEASURE_LEN_CHANNEL, BPM_CHANNEL, EXTBPM_CHANNEL, STOP_CHANNEL))
 
 # pseudoenum for DTX vs BMS parsing mode
 MODE_BMS = 0
 MODE_DTX = 1
-parsing_mode = None
-
-# dictionary of keysound index to wav
-# e.g. #WAV1Z bass.wav --> "1Z" : "bass.wav"
-keysound_dict = {}
-
-# keysound indices in list form to maintain ordering
-keysound_indices = []
-
-# dictionary of keysound index to pan (dtx only)
-keysoundpan_dict = {}
-
-# dictionary of keysound index to volume (dtx only)
-keysoundvol_dict = {}
-
-# dictionary of extended bpm index to bpm values
-# e.g. #BPM2Y 120.0 --> "2Y" : 120.0
-extbpm_dict = {}
-
-# dictionary of stop index to stop duration x/192
-# e.g. #STOP03 192 --> "03" : 192
-stop_dict = {}
-
-# dictionary of stop position to stop length
-# e.g. beat 3 : 0.5
-stop_lengths = {}
-
-# dict of beat position to bpms
-# e.g. beat 2 : 120BPM
-bpm_dict = {}
-# dict of bpm position to time position
-# e.g. beat 2 : 2.3 seconds
-bpmtime_dict = {}
-# sorted positions in terms of beats
-bpm_positions = []
-
-# dict of beat position to measure lengths
-# e.g. beat 3 : length 1.75
-measurelen_dict = {}
-# dict of measure length position to time position
-# e.g. beat 3 : 3.1 seconds
-measurelentime_dict = {}
-
-# dict of all bms notes
-# e.g. "00601" : ["01","00","23","AZ"]
-notes_dict = {}
-
-# dictionary mapping keysound index to keysound sample positions & lengths
-sample_dict = {}
-
-# dictionary mapping channel to keysound sample positions & lengths
-channelsample_dict = {}
-
-# keep track of the largest measure in the BMS
-max_measure = 0
-
-# keep track of active long notes (channel --> keysound index, active if channel exists in dict)
-active_long_notes = {}
-
-# get simple header tag value
-def get_tag_value(line, tag):
-	tag_re = re.compile("#{}(:\\s*|\\s+)([^;]+)\\s*;?".format(tag))
-	re_match = tag_re.match(line)
-	if re_match != None and re_match.start() == 0:
-		value = re_match.group(2)
-		return value
-	return None
 
-# parse header with channel and get value
-def get_header_value(line, header):
-	header_re = re.compile("#{}([\\w\\d][\\w\\d])(:\\s*|\\s+)([^;]+)\\s*;?".format(header))
-	re_match = header_re.match(line)
-	if re_match != None and re_match.start() == 0:
-		index = re_match.group(1)
-		value = re_match.group(3)
-		return index, value
-	return None, None
-
-# create dictionary of keysounds
-def add_keysound(line):
-	index, value = get_header_value(line, "WAV")
-	if index != None and value != None:
-		keysound_basename = os.path.splitext(value)[0]
-		keysound_filename = keysound_basename + WAV_EXT
-		if os.path.isfile(keysound_filename):
-			keysound_dict[index] = keysound_filename
-			keysound_indices.append(index)
-			return True
-		keysound_filename = keysound_basename + OGG_EXT
-		if os.path.isfile(keysound_filename):
-			keysound_dict[index] = keysound_filename
-			keysound_indices.append(index)
-			return True
-		keysound_filename = keysound_basename + MP3_EXT
-		if os.path.isfile(keysound_filename):
-			keysound_dict[index] = keysound_filename
-			keysound_indices.append(index)
-			return True
-		print("Warning: could not find wav/ogg/mp3 for {}".format(keysound_basename))
-	return False
-
-# create dictionary of keysound volume percentages
-def add_keysoundvolume(line):
-	index, value = get_header_value(line, "VOLUME")
-	if index != None and value != None:
-		keysoundvol_dict[index] = float(value) / 100.0
-		return True
-	return False
+# classifies a chart line in one match, alternatives are tried in order
+# simple header tags, e.g. #BPM 120
+# headers with an index, e.g. #WAV1Z bass.wav
+# channels, e.g. #00611:01002300
+LINE_RE = re.compile("#(?:"
+	"(?P<tag>BPM|VOLWAV|LNTYPE)(?::\\s*|\\s+)(?P<tag_value>[^;]+)"
+	"|(?P<header>WAV|BPM|VOLUME|PAN|STOP)(?P<index>[\\w\\d][\\w\\d])(?::\\s*|\\s+)(?P<header_value>[^;]+)"
+	"|(?P<channel>\\d\\d\\d[\\d\\w][\\d\\w])(?::\\s*|\\s+)(?P<data>\\S+))")
 
-# create dictionary of keysound pan percentages
-def add_keysoundpan(line):
-	index, value = get_header_value(line, "PAN")
-	if index != None and value != None:
-		keysoundpan_dict[index] = float(value) / 100.0
-		return True
-	return False
+# read the lines of a chart, passing each header to add_header(name, index, value) as soon as it's read,
+# index is None for simple tags, & each channel line to add_channel_line(header, data)
+# returns the number of lines
+def read_chart_lines(chart_file, add_header, add_channel_line):
+	num_lines = 0
+	line_match = LINE_RE.match
+	# assuming shift-jis encoding
+	with open(chart_file, "r", encoding="shift_jis") as chart:
+		for line in chart:
+			num_lines += 1
+			if not line.startswith("#"):
+				continue
+			re_match = line_match(line)
+			if re_match == None:
+				continue
+			kind = re_match.lastgroup
+			if kind == "data":
+				add_channel_line(re_match.group("channel"), re_match.group("data"))
+			elif kind == "header_value":
+				add_header(re_match.group("header"), re_match.group("index"), re_match.group("header_value"))
+			else:
+				add_header(re_match.group("tag"), None, re_match.group("tag_value").rstrip())
+	return num_lines
 
-# create dictionary of extended bpm values
-def add_bpmvalue(line):
-	index, value = get_header_value(line, "BPM")
-	if index != None and value != None:
-		extbpm_dict[index] = float(value)
-		return True
-	return False
-		
-# create dictionary of stop values
-def add_stopvalue(line):
-	index, value = get_header_value(line, "STOP")
-	if index != None and value != None:
-		stop_dict[index] = float(value)
-		return True
-	return False
-
-# convert channel data to an array
-def data_to_array(data):
-	out = []
-	note = ""
-	for c in data:
-		if c.isdigit() or c.isalpha(): # ignore invalid characters
-			note += c
-			if len(note) == 2:
-				out.append(note)
-				note = ""
-		elif c == ";": # DTX comment
+# add a channel line to a dict of each channel header to the data of its lines in order
+def add_channel_line(channel_lines, header, data):
+	if header in channel_lines:
+		channel_lines[header].append(data)
+	else:
+		channel_lines[header] = [data]
+
+# read the headers & channels of a chart
+# returns the headers in order as (name, index, value), index is None for simple tags,
+# a dict of each channel header to the data of its lines in order & the number of lines
+# e.g. ([("BPM", None, "120"), ("WAV", "1Z", "bass.wav")], {"00611": ["01002300"]}, 3)
+def split_chart_lines(chart_file):
+	headers = []
+	channel_lines = {}
+	num_lines = read_chart_lines(chart_file, lambda name, index, value: headers.append((name, index, value)),
+		lambda header, data: add_channel_line(channel_lines, header, data))
+	return headers, channel_lines, num_lines
+
+# wav format tags that can be measured from the data chunk size alone
+WAV_FORMAT_PCM = 0x0001
+WAV_FORMAT_IEEE_FLOAT = 0x0003
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+
+# mp3 frame header tables, indexed by mpeg version id (0 = 2.5, 2 = 2, 3 = 1)
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+MP3_L3_BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MP3_L3_BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+
+# how much of the end of an ogg file to search for the last page, grows if needed
+OGG_TAIL_SIZE = 65536
+
+# get length, frame rate & channels of a wav from its fmt & data chunks
+def probe_wav(audio_file):
+	riff = audio_file.read(12)
+	if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+		return None
+	file_size = os.fstat(audio_file.fileno()).st_size
+	fmt = None
+	while True:
+		chunk_header = audio_file.read(8)
+		if len(chunk_header) < 8:
+			return None
+		chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+		if chunk_id == b"fmt ":
+			fmt = audio_file.read(chunk_size)
+			if len(fmt) < 16:
+				return None
+			audio_file.seek(chunk_size % 2, 1)
+		elif chunk_id == b"data":
+			if fmt == None:
+				return None
+			format_tag, channels, frame_rate, byte_rate, block_align = struct.unpack("<HHIIH", fmt[0:14])
+			if format_tag == WAV_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+				format_tag = struct.unpack("<H", fmt[24:26])[0]
+			# compressed wavs (e.g. chunked vorbis) need a real decoder
+			if format_tag not in (WAV_FORMAT_PCM, WAV_FORMAT_IEEE_FLOAT) or block_align == 0 or frame_rate == 0:
+				return None
+			# truncated or streamed wavs may claim more data than the file holds
+			data_size = min(chunk_size, file_size - audio_file.tell())
+			return data_size // block_align / frame_rate, frame_rate, channels
+		else:
+			audio_file.seek(chunk_size + chunk_size % 2, 1)
+
+# get length, frame rate & channels of an ogg vorbis
+# from the identification header & the granule position of the last page
+def probe_ogg(audio_file):
+	first_page = audio_file.read(OGG_TAIL_SIZE)
+	if len(first_page) < 27 or first_page[0:4] != b"OggS":
+		return None
+	packet_start = 27 + first_page[26]
+	identification = first_page[packet_start:packet_start + 16]
+	if len(identification) < 16 or identification[0:7] != b"\x01vorbis":
+		return None
+	channels = identification[11]
+	frame_rate = struct.unpack("<I", identification[12:16])[0]
+	if frame_rate == 0:
+		return None
+	serial_number = first_page[14:18]
+
+	# search backwards for the last page of the vorbis stream
+	file_size = os.fstat(audio_file.fileno()).st_size
+	tail_size = OGG_TAIL_SIZE
+	while True:
+		tail_start = max(0, file_size - tail_size)
+		audio_file.seek(tail_start)
+		tail = audio_file.read(file_size - tail_start)
+		page_pos = tail.rfind(b"OggS")
+		while page_pos != -1:
+			if page_pos + 18 <= len(tail) and tail[page_pos+14:page_pos+18] == serial_number:
+				granule_pos = struct.unpack("<q", tail[page_pos+6:page_pos+14])[0]
+				# granule position of -1 means no packet ends on this page
+				if granule_pos >= 0:
+					return granule_pos / frame_rate, frame_rate, channels
+			page_pos = tail.rfind(b"OggS", 0, page_pos)
+		if tail_start == 0:
+			return None
+		tail_size *= 4
+
+# parse an mpeg layer 3 frame header
+# returns (frame rate, channels, samples per frame, frame size) or None
+def parse_mp3_frame_header(header):
+	if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+		return None
+	version_id = (header[1] >> 3) & 0x03
+	layer = (header[1] >> 1) & 0x03
+	bitrate_index = header[2] >> 4
+	frame_rate_index = (header[2] >> 2) & 0x03
+	padding = (header[2] >> 1) & 0x01
+	channel_mode = header[3] >> 6
+	# only layer 3 with a known bitrate & frame rate
+	if version_id == 1 or layer != 1 or bitrate_index in (0, 15) or frame_rate_index == 3:
+		return None
+	frame_rate = MP3_SAMPLE_RATES[version_id][frame_rate_index]
+	if version_id == 3:
+		bitrate = MP3_L3_BITRATES_V1[bitrate_index] * 1000
+		samples_per_frame = 1152
+	else:
+		bitrate = MP3_L3_BITRATES_V2[bitrate_index] * 1000
+		samples_per_frame = 576
+	frame_size = samples_per_frame // 8 * bitrate // frame_rate + padding
+	channels = 1 if channel_mode == 3 else 2
+	return frame_rate, channels, samples_per_frame, frame_size
+
+# get length, frame rate & channels of an mp3
+# from the xing/info or vbri tag if present, otherwise by walking the frame headers
+def probe_mp3(audio_file):
+	data = audio_file.read()
+	pos = 0
+	# skip id3v2 tag
+	if data[0:3] == b"ID3" and len(data) >= 10:
+		tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+		pos = 10 + tag_size
+		if data[5] & 0x10: # footer present
+			pos += 10
+	# find the first frame
+	while True:
+		pos = data.find(b"\xff", pos)
+		if pos == -1:
+			return None
+		first_frame = parse_mp3_frame_header(data[pos:pos+4])
+		if first_frame != None:
+			next_frame = parse_mp3_frame_header(data[pos+first_frame[3]:pos+first_frame[3]+4])
+			if next_frame != None or pos + first_frame[3] >= len(data):
+				break
+		pos += 1
+	frame_rate, channels, samples_per_frame, frame_size = first_frame
+
+	# xing/info tag sits after the side information of the first frame
+	if samples_per_frame == 1152:
+		side_info_size = 17 if channels == 1 else 32
+	else:
+		side_info_size = 9 if channels == 1 else 17
+	xing_pos = pos + 4 + side_info_size
+	if data[xing_pos:xing_pos+4] in (b"Xing", b"Info"):
+		flags = struct.unpack(">I", data[xing_pos+4:xing_pos+8])[0]
+		if flags & 0x01:
+			num_frames = struct.unpack(">I", data[xing_pos+8:xing_pos+12])[0]
+			num_samples = num_frames * samples_per_frame
+			# lame/lavc extension stores encoder delay & padding, trimmed by gapless decoders
+			lame_pos = xing_pos + 8
+			for flag in (0x01, 0x02, 0x04, 0x08):
+				if flags & flag:
+					lame_pos += 100 if flag == 0x04 else 4
+			lame_tag = data[lame_pos:lame_pos+24]
+			if len(lame_tag) == 24 and lame_tag[0:4] in (b"LAME", b"Lavc", b"Lavf"):
+				delay = (lame_tag[21] << 4) | (lame_tag[22] >> 4)
+				padding = ((lame_tag[22] & 0x0F) << 8) | lame_tag[23]
+				num_samples = max(0, num_samples - delay - padding)
+			return num_samples / frame_rate, frame_rate, channels
+	vbri_pos = pos + 4 + 32
+	if data[vbri_pos:vbri_pos+4] == b"VBRI":
+		num_frames = struct.unpack(">I", data[vbri_pos+14:vbri_pos+18])[0]
+		return num_frames * samples_per_frame / frame_rate, frame_rate, channels
+
+	# no tag, count every frame
+	num_frames = 0
+	while pos < len(data):
+		frame = parse_mp3_frame_header(data[pos:pos+4])
+		if frame == None:
 			break
-	if note != "":
-		print("Warning: odd channel data length, {}".format(data))
-	return out
+		num_frames += 1
+		pos += frame[3]
+	return num_frames * samples_per_frame / frame_rate, frame_rate, channels
+
+# how much of the start of a wav data chunk to search for an ogg page
+CHUNKED_OGG_SNIFF_SIZE = 64
+
+# check whether a wav is "chunked vorbis", i.e. ogg pages in the data chunk
+# only reads the chunk headers & the start of the data chunk
+def is_chunked_vorbis(audio_file):
+	riff = audio_file.read(12)
+	if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+		return False
+	while True:
+		chunk_header = audio_file.read(8)
+		if len(chunk_header) < 8:
+			return False
+		chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+		if chunk_id == b"data":
+			return chunkedogg_extract.OGG_MAGIC in audio_file.read(CHUNKED_OGG_SNIFF_SIZE)
+		audio_file.seek(chunk_size + chunk_size % 2, 1)
+
+# get a temporary file next to path, to write before replacing path with it
+# unique to the process & thread, so parallel conversions writing the same file don't share one
+def get_temp_file(path):
+	return "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+# extract the ogg out of a chunked vorbis wav
+# written to a temporary file first, so parallel conversions never see a partial ogg
+def extract_chunked_vorbis(keysound_file, ogg_file):
+	os.makedirs(os.path.dirname(ogg_file), exist_ok=True)
+	tmp_file = get_temp_file(ogg_file)
+	try:
+		chunkedogg_extract.extract_file(keysound_file, tmp_file)
+		os.replace(tmp_file, ogg_file)
+	except:
+		if os.path.isfile(tmp_file):
+			os.remove(tmp_file)
+		raise
+
+# get length in seconds, frame rate, channels & whether it's chunked vorbis of a keysound
+# header-only probing, falling back to a full pydub decode for unrecognized files
+# chunked vorbis wavs are extracted to ogg_file & probed as ogg, if ogg_file is given
+def probe_keysound(keysound_file, ogg_file=None):
+	info = None
+	chunked = False
+	try:
+		with open(keysound_file, "rb") as audio_file:
+			magic = audio_file.read(4)
+			audio_file.seek(0)
+			# sniff the contents, keysounds are often misnamed
+			if magic == b"RIFF" and ogg_file != None and is_chunked_vorbis(audio_file):
+				chunked = True
+			elif magic == b"RIFF":
+				audio_file.seek(0)
+				info = probe_wav(audio_file)
+			elif magic == b"OggS":
+				info = probe_ogg(audio_file)
+			elif magic[0:3] == b"ID3" or (len(magic) == 4 and parse_mp3_frame_header(magic) != None):
+				info = probe_mp3(audio_file)
+	except (OSError, struct.error, IndexError):
+		info = None
+	if chunked:
+		extract_chunked_vorbis(keysound_file, ogg_file)
+		return probe_keysound(ogg_file)[0:3] + (True,)
+	if info == None:
+		sound = import_pydub().from_file(keysound_file)
+		info = (sound.frame_count() / sound.frame_rate, sound.frame_rate, sound.channels)
+	return tuple(info) + (False,)
+
+# keysound cache location & size
+CACHE_DIR_ENV = "BMS_TO_RPP_CACHE_DIR"
+KEYSOUND_CACHE_FILE = "keysounds.sqlite3"
+KEYSOUND_CACHE_VERSION = 2
+KEYSOUND_CACHE_MAX_ENTRIES = 200000
+# oggs extracted from chunked vorbis wavs, in the cache directory
+CHUNKED_OGG_DIR = "chunked_ogg"
+
+# get the per-user cache directory
+def get_cache_dir():
+	if CACHE_DIR_ENV in os.environ:
+		return os.environ[CACHE_DIR_ENV]
+	if os.name == "nt":
+		base_dir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~\\AppData\\Local"))
+	elif sys.platform == "darwin":
+		base_dir = os.path.expanduser("~/Library/Caches")
+	else:
+		base_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+	return os.path.join(base_dir, "bms_to_rpp")
+
+# keysound infos remembered in memory by a converter, forgotten once there are more
+KEYSOUND_MEMO_MAX_ENTRIES = 100000
+
+# identify a keysound file by absolute path, size & mtime, so edited keysounds get probed again
+def get_keysound_key(keysound_file):
+	stat = os.stat(keysound_file)
+	return os.path.abspath(keysound_file), stat.st_size, stat.st_mtime_ns
+
+# get the path of the ogg extracted from a chunked vorbis wav
+# named after the wav's keysound key, so an edited wav gets extracted again
+def get_chunked_ogg_path(ogg_dir, keysound_key):
+	import hashlib
+	key_hash = hashlib.sha1("{}\n{}\n{}".format(*keysound_key).encode("utf-8", "surrogateescape")).hexdigest()
+	keysound_name = os.path.splitext(os.path.basename(keysound_key[0]))[0]
+	return os.path.join(ogg_dir, "{}.{}{}".format(keysound_name, key_hash[0:16], OGG_EXT))
+
+# compiled charts, in the cache directory
+# each file holds the trimmed samples & tempo map of one chart, enough to write the rpp or render it again
+CHART_CACHE_DIR = "charts"
+CHART_CACHE_EXT = ".bin"
+CHART_CACHE_MAGIC = b"BMS2RPPC"
+CHART_CACHE_VERSION = 3
+# least recently used compiled charts are deleted past this many
+CHART_CACHE_MAX_FILES = 2000
+# magic, version, size of the json state & number of samples
+# followed by the json state, then the sample columns & keysound timelines as little endian arrays
+CHART_CACHE_HEADER = struct.Struct("<8sIII")
+
+# get the key of a compiled chart: a hash of the chart's path, bytes & the options that change its samples
+# the keysounds are checked against the metadata stored in the compiled chart
+def get_chart_cache_key(chart_file, keysound_exts, probe_unused):
+	import hashlib
+	chart_hash = hashlib.sha1()
+	chart_hash.update("{}\n{}\n{}\n".format(os.path.abspath(chart_file), ",".join(keysound_exts), probe_unused).encode("utf-8", "surrogateescape"))
+	with open(chart_file, "rb") as chart:
+		chart_hash.update(chart.read())
+	return chart_hash.hexdigest()
+
+def get_chart_cache_dir():
+	return os.path.join(get_cache_dir(), CHART_CACHE_DIR)
+
+def get_chart_cache_path(cache_dir, key):
+	return os.path.join(cache_dir, key + CHART_CACHE_EXT)
+
+# write & read arrays of numbers as little endian
+def array_to_bytes(values):
+	if sys.byteorder == "big":
+		values = array(values.typecode, values)
+		values.byteswap()
+	return values.tobytes()
+
+def array_from_bytes(typecode, data):
+	values = array(typecode)
+	values.frombytes(data)
+	if sys.byteorder == "big":
+		values.byteswap()
+	return values
+
+# delete the least recently used compiled charts past max_files
+def evict_chart_cache(cache_dir, max_files=CHART_CACHE_MAX_FILES):
+	try:
+		with os.scandir(cache_dir) as entries:
+			cache_files = [(entry.stat().st_mtime_ns, entry.path) for entry in entries if entry.name.endswith(CHART_CACHE_EXT)]
+	except OSError:
+		return
+	cache_files.sort()
+	for mtime, cache_file in cache_files[:max(0, len(cache_files) - max_files)]:
+		try:
+			os.remove(cache_file)
+		except OSError:
+			pass
+
+# persistent cache of keysound length, frame rate, channels & whether it's chunked vorbis
+# entries are keyed on absolute path, size & mtime, so edited keysounds get probed again
+# least recently used entries are evicted once the cache grows past max_entries
+# one cache can be shared by converters running in several threads
+class KeysoundCache:
+	def __init__(self, cache_file, max_entries=KEYSOUND_CACHE_MAX_ENTRIES):
+		cache_dir = os.path.dirname(cache_file)
+		if cache_dir != "":
+			os.makedirs(cache_dir, exist_ok=True)
+		self.max_entries = max_entries
+		# hits & new entries are written in one short transaction by flush()
+		# so parallel batch workers don't hold the database lock while probing
+		self.used_paths = []
+		self.new_entries = []
+		self.lock = threading.Lock()
+		import sqlite3
+		self.db = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+		if self.db.execute("PRAGMA user_version").fetchone()[0] != KEYSOUND_CACHE_VERSION:
+			self.db.execute("DROP TABLE IF EXISTS keysounds")
+			self.db.execute("PRAGMA user_version = {}".format(KEYSOUND_CACHE_VERSION))
+		self.db.execute("CREATE TABLE IF NOT EXISTS keysounds ("
+			"path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+			"length REAL, frame_rate INTEGER, channels INTEGER, chunked INTEGER, last_used REAL)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS keysounds_last_used ON keysounds (last_used)")
+		self.db.commit()
+
+	# get (length, frame rate, channels, chunked) of a cached keysound, or None
+	def get(self, key):
+		path, size, mtime = key
+		with self.lock:
+			row = self.db.execute("SELECT length, frame_rate, channels, chunked FROM keysounds "
+				"WHERE path = ? AND size = ? AND mtime = ?", (path, size, mtime)).fetchone()
+			if row != None:
+				self.used_paths.append(path)
+		return row
+
+	def put(self, key, info):
+		with self.lock:
+			self.new_entries.append(key + tuple(info))
+
+	# save hits & new entries
+	def flush(self):
+		import sqlite3
+		now = time.time()
+		with self.lock:
+			try:
+				with self.db:
+					self.db.executemany("UPDATE keysounds SET last_used = ? WHERE path = ?",
+						[(now, path) for path in self.used_paths])
+					self.db.executemany("INSERT OR REPLACE INTO keysounds VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+						[entry + (now,) for entry in self.new_entries])
+			except sqlite3.Error as e:
+				print("Warning: could not update keysound cache, {}".format(e))
+			self.used_paths = []
+			self.new_entries = []
+
+	def clear(self):
+		with self.lock:
+			self.db.execute("DELETE FROM keysounds")
+			self.db.commit()
+
+	# save, evict least recently used entries & close
+	def close(self):
+		self.flush()
+		with self.lock:
+			num_entries = self.db.execute("SELECT COUNT(*) FROM keysounds").fetchone()[0]
+			if num_entries > self.max_entries:
+				self.db.execute("DELETE FROM keysounds WHERE path IN "
+					"(SELECT path FROM keysounds ORDER BY last_used LIMIT ?)", (num_entries - self.max_entries,))
+			self.db.commit()
+			self.db.close()
+
+# keysound file extensions tried for a #WAV value, in order of priority
+KEYSOUND_EXTS = (WAV_EXT, OGG_EXT, MP3_EXT)
+# keysound indexes kept in memory, forgotten once there are more
+KEYSOUND_INDEX_MAX_DIRS = 1000
+
+# index of the files in a chart directory & its subdirectories
+# each directory is listed once with os.scandir, when a #WAV first refers to it
+# lookups ignore case, as charts are mostly made on windows
+# a listed directory is listed again if its mtime changed, checked by refresh()
+# one index can be shared by every chart in a directory & by several threads
+class KeysoundIndex:
+	def __init__(self, base_dir):
+		self.base_dir = base_dir
+		# listed directories by path relative to base_dir
+		# e.g. "sounds" --> (mtime, ({"Kick.wav"}, {"kick.wav": "Kick.wav"}), ({"Drums"}, {"drums": "Drums"}))
+		self.dirs = {}
+		self.lock = threading.Lock()
+
+	# forget directories that changed since they were listed
+	def refresh(self):
+		with self.lock:
+			for dir_key in list(self.dirs):
+				try:
+					mtime = os.stat(os.path.join(self.base_dir, dir_key)).st_mtime_ns
+				except OSError:
+					mtime = None
+				if mtime != self.dirs[dir_key][0]:
+					del self.dirs[dir_key]
+
+	# get the mtime, files & subdirectories of a directory relative to base_dir
+	# files & subdirectories are each a set of names as they are on disk & a dictionary of lowercase name to name
+	def list_dir(self, dir_key):
+		with self.lock:
+			listing = self.dirs.get(dir_key)
+			if listing == None:
+				files = (set(), {})
+				subdirs = (set(), {})
+				dir_path = os.path.join(self.base_dir, dir_key)
+				try:
+					mtime = os.stat(dir_path).st_mtime_ns
+					with os.scandir(dir_path) as entries:
+						for entry in entries:
+							try:
+								if entry.is_file():
+									names = files
+								elif entry.is_dir():
+									names = subdirs
+								else:
+									continue
+							except OSError:
+								continue
+							exact_names, lower_names = names
+							exact_names.add(entry.name)
+							# same name in different cases, only on case sensitive file systems
+							lower_name = entry.name.lower()
+							if lower_name not in lower_names or entry.name < lower_names[lower_name]:
+								lower_names[lower_name] = entry.name
+				except OSError:
+					mtime = None
+				listing = (mtime, files, subdirs)
+				self.dirs[dir_key] = listing
+		return listing
+
+	# find a name in the names of a listed directory, exact case first
+	def match_name(self, names, name):
+		exact_names, lower_names = names
+		if name in exact_names:
+			return name
+		return lower_names.get(name.lower())
+
+	# find the keysound file for a #WAV value, trying each of exts in order instead of its extension
+	# returns the filename relative to base_dir, or None
+	def find(self, value, exts=KEYSOUND_EXTS):
+		# charts made on windows use backslashes
+		parts = re.split(r"[\\/]", value)
+		dir_key = ""
+		for part in parts[:-1]:
+			if part in ("", "."):
+				continue
+			if part != "..":
+				part = self.match_name(self.list_dir(dir_key)[2], part)
+				if part == None:
+					return None
+			dir_key = os.path.join(dir_key, part)
+		files = self.list_dir(dir_key)[1]
+		keysound_basename = os.path.splitext(parts[-1])[0]
+		for ext in exts:
+			keysound_filename = self.match_name(files, keysound_basename + ext)
+			if keysound_filename != None:
+				return os.path.join(dir_key, keysound_filename)
+		return None
+
+# keysound indexes by absolute directory, shared by every converter
+keysound_indexes = {}
+keysound_indexes_lock = threading.Lock()
+
+# get the keysound index of a directory, up to date with any files added or removed since it was last used
+def get_keysound_index(base_dir):
+	base_dir = os.path.abspath(base_dir)
+	with keysound_indexes_lock:
+		index = keysound_indexes.get(base_dir)
+		if index == None:
+			if len(keysound_indexes) >= KEYSOUND_INDEX_MAX_DIRS:
+				keysound_indexes.clear()
+			index = KeysoundIndex(base_dir)
+			keysound_indexes[base_dir] = index
+			return index
+	index.refresh()
+	return index
+
+# write text chunks to a binary stream in large blocks
+# newlines & encoding match a file opened in text mode
+# returns the number of bytes written
+def write_chunks(chunks, out_stream):
+	encoding = locale.getpreferredencoding(False)
+	num_bytes = 0
+	block = []
+	block_size = 0
+	for chunk in chunks:
+		block.append(chunk)
+		block_size += len(chunk)
+		if block_size >= RPP_WRITE_BLOCK_SIZE:
+			num_bytes += write_block(block, out_stream, encoding)
+			block = []
+			block_size = 0
+	if len(block) > 0:
+		num_bytes += write_block(block, out_stream, encoding)
+	return num_bytes
+
+# encode & write one block of text chunks, returns the number of bytes written
+def write_block(block, out_stream, encoding):
+	text = "".join(block)
+	if os.linesep != "\n":
+		text = text.replace("\n", os.linesep)
+	data = text.encode(encoding)
+	out_stream.write(data)
+	return len(data)
 
 # least common multiple
 def lcm(a,b):
-	return int(a*b/math.gcd(a,b))
+	return a*b // math.gcd(a,b)
 
 # merge the data of multiple instances of the same channel
+# both are rescaled to the lcm of their resolutions, so merging costs as much as their notes
 def update_data(old_data, new_data):
-	old_data_len = len(old_data)
-	new_data_len = len(new_data)
-	data_lcm = lcm(old_data_len, new_data_len)
-	old_data_factor = data_lcm/old_data_len
-	new_data_factor = data_lcm/new_data_len
-	merged_data = [0]*data_lcm
-	for i in range(data_lcm):
-		if i % old_data_factor == 0:
-			old_data_value = old_data[int(i/old_data_factor)]
+	old_resolution, old_notes = old_data
+	new_resolution, new_notes = new_data
+	if old_resolution == 0:
+		return new_data
+	if new_resolution == 0:
+		return old_data
+	data_lcm = lcm(old_resolution, new_resolution)
+	old_data_factor = data_lcm // old_resolution
+	new_data_factor = data_lcm // new_resolution
+	merged_notes = {slot * old_data_factor: value for slot, value in old_notes.items()}
+	# give priority to the newer data, 00 is never stored so it can't overwrite older notes
+	for slot, value in new_notes.items():
+		merged_notes[slot * new_data_factor] = value
+	return data_lcm, {slot: merged_notes[slot] for slot in sorted(merged_notes)}
+
+# tempo map of a chart, built once all bpms, stops & measure lengths are known
+# stores seconds from the start of each measure to each bpm marker, seconds of each stop
+# & the start time of each measure, so a beat position is resolved with binary searches
+# sums are done in the same order as walking the bpms & stops, so times are unchanged
+class TempoMap:
+	def __init__(self, bpm_positions, bpm_dict, stop_lengths, measure_lens):
+		# sorted bpm positions & their bpms
+		self.bpm_positions = bpm_positions
+		self.bpms = [bpm_dict[bpm_pos] for bpm_pos in bpm_positions]
+		# length of each measure
+		self.measure_lens = measure_lens
+
+		# index of the bpm in effect at the start of each measure
+		self.measure_bpm_indices = [bisect.bisect_right(bpm_positions, measure_num) - 1 for measure_num in range(len(measure_lens))]
+
+		# seconds from the start of its measure to each bpm marker, stops excluded
+		self.bpm_offsets = [0] * len(bpm_positions)
+		for i in range(1, len(bpm_positions)):
+			bpm_pos = bpm_positions[i]
+			measure_num = int(bpm_pos)
+			if bpm_pos == measure_num or measure_num >= len(measure_lens):
+				continue
+			measure_len = measure_lens[measure_num]
+			prev_bpm_pos = bpm_positions[i-1]
+			if prev_bpm_pos <= measure_num:
+				# first bpm marker after the start of the measure
+				self.bpm_offsets[i] = (bpm_pos - measure_num) * MPS_FACTOR * measure_len / self.bpms[i-1]
+			else:
+				self.bpm_offsets[i] = self.bpm_offsets[i-1] + (bpm_pos - prev_bpm_pos) * MPS_FACTOR * measure_len / self.bpms[i-1]
+
+		# sorted stop positions & their lengths in seconds, at the bpm in effect at the stop
+		self.stop_positions = sorted(stop_lengths)
+		self.stop_seconds = []
+		for stop_pos in self.stop_positions:
+			stop_bpm = self.bpms[bisect.bisect_right(bpm_positions, stop_pos) - 1]
+			self.stop_seconds.append(stop_lengths[stop_pos] * MPS_FACTOR / stop_bpm)
+
+		# start time of each measure, plus the end of the last measure
+		self.measure_times = [0]
+		for measure_num in range(len(measure_lens)):
+			self.measure_times.append(self.measure_times[-1] + self.measure_offset_seconds(measure_num, measure_num + 1))
+
+	# for 1 measure, convert a beat position into a time offset within the measure
+	# accounting for bpms & stops
+	def measure_offset_seconds(self, measure_num, beatpos):
+		measure_len = self.measure_lens[measure_num]
+
+		# time at the last bpm marker before the beat
+		measure_bpm_i = self.measure_bpm_indices[measure_num]
+		bpm_i = bisect.bisect_left(self.bpm_positions, beatpos) - 1
+		if bpm_i <= measure_bpm_i:
+			bpm_i = measure_bpm_i
+			bpmpos = measure_num
+			current_time = 0
+		else:
+			bpmpos = self.bpm_positions[bpm_i]
+			current_time = self.bpm_offsets[bpm_i]
+
+		# add stops in the measure before the beat
+		stop_i = bisect.bisect_left(self.stop_positions, measure_num)
+		stop_end_i = bisect.bisect_left(self.stop_positions, beatpos)
+		while stop_i < stop_end_i:
+			current_time += self.stop_seconds[stop_i]
+			stop_i += 1
+
+		# add remaining time based on last bpm marker
+		current_time += (beatpos - bpmpos) * MPS_FACTOR * measure_len / self.bpms[bpm_i]
+		return current_time
+
+	# convert a beat position within a measure into seconds
+	def seconds(self, measure_num, beatpos):
+		return self.measure_times[measure_num] + self.measure_offset_seconds(measure_num, beatpos)
+
+	# convert arrays of measure numbers & beat positions into seconds in one pass with numpy
+	# same operations in the same order as seconds(), so the results are identical
+	def seconds_array(self, measure_nums, beatpos):
+		measure_nums = numpy.asarray(measure_nums, dtype=numpy.int64)
+		beatpos = numpy.asarray(beatpos, dtype=numpy.float64)
+		bpm_positions = numpy.asarray(self.bpm_positions, dtype=numpy.float64)
+		bpms = numpy.asarray(self.bpms, dtype=numpy.float64)
+
+		# time at the last bpm marker before each beat
+		measure_bpm_i = numpy.asarray(self.measure_bpm_indices, dtype=numpy.int64)[measure_nums]
+		bpm_i = numpy.searchsorted(bpm_positions, beatpos, side="left") - 1
+		from_measure_start = bpm_i <= measure_bpm_i
+		bpm_i = numpy.where(from_measure_start, measure_bpm_i, bpm_i)
+		bpmpos = numpy.where(from_measure_start, measure_nums.astype(numpy.float64), bpm_positions[bpm_i])
+		current_time = numpy.where(from_measure_start, 0.0, numpy.asarray(self.bpm_offsets, dtype=numpy.float64)[bpm_i])
+
+		# add stops in the measure before each beat, one stop at a time to keep the order of the sums
+		if len(self.stop_positions) != 0:
+			stop_positions = numpy.asarray(self.stop_positions, dtype=numpy.float64)
+			stop_seconds = numpy.asarray(self.stop_seconds, dtype=numpy.float64)
+			stop_i = numpy.searchsorted(stop_positions, measure_nums, side="left")
+			num_stops = numpy.searchsorted(stop_positions, beatpos, side="left") - stop_i
+			for s in range(int(num_stops.max(initial=0))):
+				has_stop = s < num_stops
+				current_time = current_time + numpy.where(has_stop, stop_seconds[numpy.minimum(stop_i + s, len(stop_seconds) - 1)], 0.0)
+
+		# add remaining time based on last bpm marker
+		measure_lens = numpy.asarray(self.measure_lens, dtype=numpy.float64)[measure_nums]
+		current_time = current_time + (beatpos - bpmpos) * MPS_FACTOR * measure_lens / bpms[bpm_i]
+		return numpy.asarray(self.measure_times, dtype=numpy.float64)[measure_nums] + current_time
+
+# mixdown format, any keysound is resampled to this
+RENDER_FRAME_RATE = 44100
+RENDER_CHANNELS = 2
+# frames mixed at a time
+RENDER_BLOCK_FRAMES = 1 << 16
+# decoded keysounds kept in memory while rendering, least recently used ones are forgotten past this
+RENDER_CACHE_MAX_BYTES = 256 << 20
+FLAC_EXT = ".flac"
+RENDER_EXTS = (WAV_EXT, FLAC_EXT)
+
+# decode a pcm wav with the wave module, like pydub would
+# returns a float32 numpy array of shape (frames, 2), or None for wavs that need resampling or pydub
+def decode_wav(keysound_file, frame_rate=RENDER_FRAME_RATE):
+	try:
+		with wave.open(keysound_file, "rb") as wav:
+			channels = wav.getnchannels()
+			sample_width = wav.getsampwidth()
+			if wav.getframerate() != frame_rate or channels > RENDER_CHANNELS or sample_width not in (1, 2, 3, 4):
+				return None
+			data = wav.readframes(wav.getnframes())
+	except (OSError, EOFError, wave.Error):
+		return None
+	data = data[:len(data) - len(data) % (sample_width * channels)]
+	if sample_width == 1:
+		# 8 bit wavs are unsigned
+		samples = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float32) - 128.0
+	elif sample_width == 3:
+		# pydub reads 24 bit samples as 32 bit, with a low byte of 0xff for negative samples
+		padded = numpy.zeros((len(data) // 3, 4), dtype=numpy.uint8)
+		padded[:, 1:] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+		padded[:, 0] = numpy.where(padded[:, 3] > 127, 0xFF, 0)
+		samples = padded.view("<i4").reshape(-1).astype(numpy.float32)
+		sample_width = 4
+	else:
+		samples = numpy.frombuffer(data, dtype="<i{}".format(sample_width)).astype(numpy.float32)
+	samples /= float(1 << (8 * sample_width - 1))
+	samples = samples.reshape(-1, channels)
+	if channels == 1:
+		samples = numpy.repeat(samples, RENDER_CHANNELS, axis=1)
+	return samples
+
+# decode a keysound into a float32 numpy array of shape (frames, 2), between -1 & 1
+# pcm wavs at the render frame rate are read directly, anything else is decoded & resampled by pydub
+def decode_keysound(keysound_file, frame_rate=RENDER_FRAME_RATE):
+	samples = decode_wav(keysound_file, frame_rate)
+	if samples is not None:
+		return samples
+	AudioSegment = import_pydub()
+	sound = AudioSegment.from_file(keysound_file)
+	if sound.channels > 2:
+		sound = AudioSegment.from_mono_audiosegments(*sound.split_to_mono()[0:2])
+	sound = sound.set_frame_rate(frame_rate).set_channels(RENDER_CHANNELS)
+	samples = numpy.array(sound.get_array_of_samples(), dtype=numpy.float32)
+	samples /= float(1 << (8 * sound.sample_width - 1))
+	return samples.reshape(-1, RENDER_CHANNELS)
+
+# decoded keysounds by file, for rendering
+# least recently used keysounds are forgotten once they take more than max_bytes
+class DecodedKeysoundCache:
+	def __init__(self, frame_rate=RENDER_FRAME_RATE, max_bytes=RENDER_CACHE_MAX_BYTES):
+		self.frame_rate = frame_rate
+		self.max_bytes = max_bytes
+		self.num_bytes = 0
+		self.entries = OrderedDict()
+
+	def get(self, keysound_file):
+		audio = self.entries.get(keysound_file)
+		if audio is not None:
+			self.entries.move_to_end(keysound_file)
+			return audio
+		audio = decode_keysound(keysound_file, self.frame_rate)
+		self.entries[keysound_file] = audio
+		self.num_bytes += audio.nbytes
+		while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+			self.num_bytes -= self.entries.popitem(last=False)[1].nbytes
+		return audio
+
+# writes 16 bit stereo frames to a wav with the wave module, or to a flac through ffmpeg
+class RenderWriter:
+	def __init__(self, out_file, flac=False, frame_rate=RENDER_FRAME_RATE):
+		self.wav = None
+		self.ffmpeg = None
+		if flac:
+			import subprocess
+			try:
+				self.ffmpeg = subprocess.Popen([import_pydub().converter, "-y", "-loglevel", "error",
+					"-f", "s16le", "-ar", str(frame_rate), "-ac", str(RENDER_CHANNELS), "-i", "-",
+					"-f", "flac", out_file], stdin=subprocess.PIPE)
+			except OSError as e:
+				raise ConversionError("Could not start ffmpeg/avconv to write {}: {}".format(out_file, e))
 		else:
-			old_data_value = "00"
-		if i % new_data_factor == 0:
-			new_data_value = new_data[int(i/new_data_factor)]
+			self.wav = wave.open(out_file, "wb")
+			self.wav.setnchannels(RENDER_CHANNELS)
+			self.wav.setsampwidth(2)
+			self.wav.setframerate(frame_rate)
+
+	# write a float block of shape (frames, 2), clipped to 16 bits
+	def write(self, block):
+		frames = numpy.clip(numpy.rint(block * 32767.0), -32768, 32767).astype("<i2").tobytes()
+		if self.wav != None:
+			self.wav.writeframesraw(frames)
 		else:
-			new_data_value = "00"
-			
-		# give priority to the newer data unless newer data is 00
-		if new_data_value == "00":
-			merged_data[i] = old_data_value
+			self.ffmpeg.stdin.write(frames)
+
+	def close(self):
+		if self.wav != None:
+			self.wav.close()
 		else:
-			merged_data[i] = new_data_value
-	return merged_data
-
-# identify channels & save their data
-def add_channel(line):
-	global max_measure
-	# use regular expression to match the channel format
-	note_re = re.compile("#(\\d\\d\\d[\\d\\w][\\d\\w])(:\\s*|\\s+)(\\S+)")
-	re_match = note_re.match(line)
-	if re_match != None and re_match.start() == 0:
-		header = re_match.group(1)
+			self.ffmpeg.stdin.close()
+			if self.ffmpeg.wait() != 0:
+				raise ConversionError("ffmpeg/avconv failed to write the flac")
+
+	# stop writing after an error, without checking anything
+	def abort(self):
+		try:
+			if self.wav != None:
+				self.wav.close()
+			else:
+				self.ffmpeg.stdin.close()
+				self.ffmpeg.wait()
+		except (OSError, wave.Error):
+			pass
+
+# converts BMS & DTX charts into rpps
+# owns all of the parse state of one chart, so separate converters can run in parallel
+# keysounds are resolved relative to the chart, not the working directory
+class ChartConverter:
+	def __init__(self, keysound_cache=None, probe_jobs=None, verbose=True, use_numpy=True, keep_track_items=False, chunked_ogg_dir=None, keysound_exts=KEYSOUND_EXTS, probe_unused=False, chart_cache_dir=None):
+		# persistent keysound metadata cache, None if disabled
+		self.keysound_cache = keysound_cache
+		# where compiled charts are kept, None if disabled
+		self.chart_cache_dir = chart_cache_dir
+		# where oggs extracted from chunked vorbis wavs are kept
+		self.chunked_ogg_dir = chunked_ogg_dir if chunked_ogg_dir != None else os.path.join(get_cache_dir(), CHUNKED_OGG_DIR)
+		# keysound file extensions to look for, in order of priority
+		self.keysound_exts = keysound_exts
+		# probe every #WAV keysound, instead of only those that notes refer to
+		self.probe_unused = probe_unused
+		# number of keysounds to probe in parallel
+		self.probe_jobs = probe_jobs if probe_jobs != None else (os.cpu_count() or 1)
+		# print progress & warnings
+		self.verbose = verbose
+		# compute note times with numpy for large charts, if installed
+		self.use_numpy = use_numpy and has_numpy()
+		# keysound infos by keysound key, kept between conversions
+		self.keysound_memo = {}
+		# keep the rpp text of each track's items, so reconvert() only formats changed tracks
+		self.keep_track_items = keep_track_items
+		# decoded keysounds for rendering, created on the first render & kept between conversions
+		self.decoded_keysounds = None
+		# background keysound probing, started while the chart is read
+		self.probe_pool = None
+		self.reset()
+
+	# reset all parse state before converting another chart
+	def reset(self):
+		# pseudoenum for DTX vs BMS parsing mode
+		self.parsing_mode = None
+
+		# path of the chart & its directory, keysound filenames are relative to the directory
+		self.chart_path = None
+		self.chart_dir = ""
+		# index of the files in the chart directory, for finding keysounds
+		self.keysound_index = None
+
+		# dictionary of keysound index to wav
+		# e.g. #WAV1Z bass.wav --> "1Z" : "bass.wav"
+		self.keysound_dict = {}
+
+		# keysound indices in list form to maintain ordering
+		self.keysound_indices = []
+
+		# dictionary of keysound index to the ogg extracted from a chunked vorbis wav
+		self.chunked_oggs = {}
+
+		# dictionary of keysound index to pan (dtx only)
+		self.keysoundpan_dict = {}
+
+		# dictionary of keysound index to volume (dtx only)
+		self.keysoundvol_dict = {}
+
+		# dictionary of extended bpm index to bpm values
+		# e.g. #BPM2Y 120.0 --> "2Y" : 120.0
+		self.extbpm_dict = {}
+
+		# dictionary of stop index to stop duration x/192
+		# e.g. #STOP03 192 --> "03" : 192
+		self.stop_dict = {}
+
+		# dictionary of stop position to stop length
+		# e.g. beat 3 : 0.5
+		self.stop_lengths = {}
+
+		# dict of beat position to bpms
+		# e.g. beat 2 : 120BPM
+		self.bpm_dict = {}
+		# dict of bpm position to time position
+		# e.g. beat 2 : 2.3 seconds
+		self.bpmtime_dict = {}
+		# sorted positions in terms of beats
+		self.bpm_positions = []
+
+		# dict of beat position to measure lengths
+		# e.g. beat 3 : length 1.75
+		self.measurelen_dict = {}
+		# dict of measure length position to time position
+		# e.g. beat 3 : 3.1 seconds
+		self.measurelentime_dict = {}
+
+		# tempo map built from the bpms, stops & measure lengths
+		self.tempo_map = None
+
+		# dict of all bms notes, as the resolution of the channel & its non-00 notes by slot
+		# e.g. "00601" : (4, {0: "01", 2: "23", 3: "AZ"})
+		self.notes_dict = {}
+
+		# dictionary mapping keysound index to keysound length in seconds
+		self.keysound_lengths = {}
+
+		# keysound indices referred to by notes of the playable channels
+		self.referenced_keysounds = set()
+
+		# keys of the probed keysounds by keysound index, as absolute path, size & mtime
+		self.keysound_keys = {}
+		# keysound names looked up in the chart's directory & the files found, None if missing
+		self.keysound_lookups = []
+
+		# key of the chart in the chart cache, & whether it was loaded from there
+		self.chart_cache_key = None
+		self.from_chart_cache = False
+
+		# keysound lookups started but not waited for yet, by keysound index & by path
+		self.shutdown_probes()
+		self.probe_futures = {}
+		self.probe_paths = {}
+
+		# keysound samples, stored as columns indexed by sample number
+		# time position & length in seconds, keysound id & channel id of each sample
+		self.sample_pos = array("d")
+		self.sample_length = array("d")
+		self.sample_keysound = array("l")
+		self.sample_channel = array("l")
+
+		# ids of keysound indices & channels with samples, & the reverse lists
+		self.keysound_ids = {}
+		self.id_keysounds = []
+		self.channel_ids = {}
+		self.id_channels = []
+
+		# dictionary mapping keysound index to its sample numbers
+		self.sample_dict = {}
+
+		# dictionary mapping channel to its sample numbers
+		self.channelsample_dict = {}
+
+		# keep track of the largest measure in the BMS
+		self.max_measure = 0
+
+		# headers & lines of each channel as read from the chart, to find edits in reconvert()
+		self.chart_headers = []
+		self.channel_lines = {}
+
+		# notes of each measure with their channels, keysounds & time positions
+		# e.g. 6 : (["11", "11"], ["01", "23"], [10.5, 10.75])
+		self.measure_notes = {}
+
+		# keep track of active long notes (channel --> keysound index, active if channel exists in dict)
+		self.active_long_notes = {}
+
+		# master volume of the chart, default to 100.0
+		self.master_volume = 100.0
+
+		# default 120 chart bpm
+		self.chart_bpm = 120.0
+
+		# warnings printed during the conversion
+		self.warnings = []
+
+		# where progress & warnings are printed, stderr if the rpp goes to stdout
+		self.log_file = sys.stdout
+
+		# number of items & bytes in the written rpp
+		self.rpp_items = 0
+		self.rpp_bytes = 0
+
+		# wall & cpu seconds of each phase of the conversion
+		self.phase_times = {}
+
+		# number of lines in the chart
+		self.num_lines = 0
+		self.num_notes = 0
+
+		# whether the last conversion finished, so reconvert() can start from its state
+		self.converted = False
+
+		# rpp text & number of items of each track, with the item tail, positions & lengths it was made from
+		# only kept with keep_track_items
+		self.track_items = {}
+
+	def log(self, message):
+		if self.verbose:
+			print(message, file=self.log_file)
+
+	# print a warning & remember it for the batch report
+	def warn(self, message):
+		self.log("Warning: {}".format(message))
+		self.warnings.append(message)
+
+	# convert a chart into an rpp, out_path defaults to the chart name with .rpp
+	# a .gz out_path is gzipped, "-" writes to stdout
+	# render_path also mixes the chart down to a wav or flac
+	def convert(self, chart_path, out_path=None, render_path=None):
+		self.reset()
+		if out_path == RPP_STDOUT:
+			self.log_file = sys.stderr
+		chart_ext = os.path.splitext(chart_path)[1].lower()
+		if chart_ext in BMS_EXTS:
+			self.parsing_mode = MODE_BMS
+		elif chart_ext == DTX_EXT:
+			self.parsing_mode = MODE_DTX
+		else:
+			raise ConversionError("Unknown chart file type: {}".format(chart_ext))
+		if out_path == None:
+			out_path = os.path.splitext(chart_path)[0] + RPP_EXT
+		self.chart_path = chart_path
+		self.chart_dir = os.path.dirname(os.path.abspath(chart_path))
+
+		# reading starts probing keysounds, so the probes are stopped if anything fails until they're done
+		try:
+			if not self.run_phase("read", self.read_cached_chart, chart_path):
+				self.run_phase("timing", self.compute_timing)
+				self.run_phase("probe", self.get_keysound_lengths)
+		except:
+			self.shutdown_probes()
+			raise
+		if not self.from_chart_cache:
+			self.run_phase("trim", self.trim_samples)
+			if self.chart_cache_key != None:
+				self.run_phase("cache", self.save_chart_cache)
+		self.run_phase("write", self.write_rpp, out_path)
+		if render_path != None:
+			self.run_phase("render", self.render, render_path)
+		self.converted = True
+
+	# convert a chart again after it was edited, starting from the state of the last conversion
+	# only changed channels are parsed again, & only notes from the first measure with a tempo change
+	# (or in changed measures) are timed again
+	# edits to anything other than channels convert the whole chart again
+	def reconvert(self, chart_path, out_path=None, render_path=None):
+		# a chart loaded from the chart cache has no parsed channels to update
+		if not self.converted or self.from_chart_cache or chart_path != self.chart_path:
+			return self.convert(chart_path, out_path, render_path)
+		if out_path == None:
+			out_path = os.path.splitext(chart_path)[0] + RPP_EXT
+		self.converted = False
+		self.warnings = []
+		self.phase_times = {}
+
+		try:
+			changes = self.run_phase("read", self.update_channels, chart_path)
+			if changes != None:
+				self.run_phase("timing", self.retime, *changes)
+				self.run_phase("probe", self.get_keysound_lengths)
+		except:
+			self.shutdown_probes()
+			raise
+		if changes == None:
+			# drop the lookups started for the edited channels, the whole chart is read again
+			self.shutdown_probes()
+			self.log("Headers changed, converting the whole chart")
+			return self.convert(chart_path, out_path, render_path)
+		self.active_long_notes = {}
+		self.run_phase("trim", self.trim_samples)
+		self.run_phase("write", self.write_rpp, out_path)
+		if render_path != None:
+			self.run_phase("render", self.render, render_path)
+		self.converted = True
+
+	# run one phase of the conversion, recording its wall & cpu time
+	# cpu time is for the whole process, including probing threads
+	def run_phase(self, name, phase, *args):
+		wall_start = time.perf_counter()
+		cpu_start = time.process_time()
+		result = phase(*args)
+		self.phase_times[name] = (time.perf_counter() - wall_start, time.process_time() - cpu_start)
+		return result
+
+	# count the notes in the playable channels
+	def count_notes(self):
+		if self.parsing_mode == MODE_DTX:
+			playable_channels = DTX_PLAYABLE_CHANNELS
+		else:
+			playable_channels = BMS_PLAYABLE_CHANNELS
+		num_notes = 0
+		for header in self.notes_dict:
+			channel = header[3:5]
+			if channel == "01":
+				num_notes += sum(len(channel_data[1]) for channel_data in self.notes_dict[header])
+			elif channel in playable_channels:
+				num_notes += len(self.notes_dict[header][1])
+		return num_notes
+
+	# count the keysounds that weren't probed, as no note refers to them
+	def count_skipped_keysounds(self):
+		return sum(1 for keysound in self.keysound_dict if keysound not in self.keysound_lengths)
+
+	# get the phase times & counters of the last conversion
+	def get_profile(self):
+		phases = {}
+		for name in PHASES:
+			if name in self.phase_times:
+				wall, cpu = self.phase_times[name]
+				phases[name] = {"wall": wall, "cpu": cpu}
+		counters = {
+			"lines": self.num_lines,
+			"notes": self.num_notes,
+			"samples": len(self.sample_pos),
+			"samples_trimmed": sum(1 for length in self.sample_length if length <= 0),
+			"wavs_skipped": self.count_skipped_keysounds(),
+			"tracks": sum(1 for keysound_index in self.keysound_indices if keysound_index in self.sample_dict),
+			"items": self.rpp_items,
+			"bytes": self.rpp_bytes,
+		}
+		return {
+			"chart": self.chart_path,
+			"phases": phases,
+			"wall": sum(phase["wall"] for phase in phases.values()),
+			"cpu": sum(phase["cpu"] for phase in phases.values()),
+			"counters": counters,
+		}
+
+	# get the absolute path of a keysound from its filename relative to the chart's directory
+	def get_keysound_path(self, keysound_filename):
+		return os.path.join(self.chart_dir, keysound_filename)
+
+	# create dictionary of keysounds
+	def add_keysound(self, index, value):
+		keysound_filename = self.keysound_index.find(value, self.keysound_exts)
+		self.keysound_lookups.append((value, keysound_filename))
+		if keysound_filename != None:
+			self.keysound_dict[index] = keysound_filename
+			self.keysound_indices.append(index)
+			# a note may refer to the keysound before its #WAV
+			if self.probe_unused or index in self.referenced_keysounds:
+				self.submit_probe(index)
+		else:
+			self.warn("could not find {} for {}".format("/".join(ext[1:] for ext in self.keysound_exts), os.path.splitext(value)[0]))
+
+	# create dictionary of keysound volume percentages
+	def add_keysoundvolume(self, index, value):
+		self.keysoundvol_dict[index] = float(value) / 100.0
+
+	# create dictionary of keysound pan percentages
+	def add_keysoundpan(self, index, value):
+		self.keysoundpan_dict[index] = float(value) / 100.0
+
+	# create dictionary of extended bpm values
+	def add_bpmvalue(self, index, value):
+		self.extbpm_dict[index] = float(value)
+
+	# create dictionary of stop values
+	def add_stopvalue(self, index, value):
+		self.stop_dict[index] = float(value)
+
+	# set the value of a simple header tag
+	def set_tag(self, tag, data):
+		# locate chart bpm
+		if tag == "BPM":
+			# beats (measures) start at 1, not 0
+			try:
+				self.chart_bpm = float(data)
+			except:
+				self.warn("invalid #BPM value {}".format(data))
+				return
+			self.bpm_dict[0.0] = self.chart_bpm
+			self.bpm_positions = [0.0]
+			self.bpmtime_dict[0.0] = 0
+		# locate & set master volume
+		elif tag == "VOLWAV":
+			try:
+				self.master_volume = float(data)
+			except:
+				self.warn("invalid #VOLWAV value {}".format(data))
+		# check lntype (only type 1 supported)
+		elif tag == "LNTYPE":
+			try:
+				if int(data) != 1:
+					self.warn("unsupported #LNTYPE {}, only #LNTYPE 1 is supported".format(data))
+			except:
+				self.warn("invalid #LNTYPE value {}, only #LNTYPE 1 is supported".format(data))
+
+	# convert channel data to sparse notes
+	# returns the number of slots & a dict of each non-00 slot to its value, in slot order
+	# e.g. "01002300" --> (4, {0: "01", 2: "23"})
+	def data_to_notes(self, data):
+		notes = data.split(";", 1)[0] # DTX comment
+		if not (notes.isascii() and notes.isalnum()):
+			# ignore invalid characters
+			notes = "".join([c for c in notes if c.isdigit() or c.isalpha()])
+		if len(notes) % 2 != 0:
+			self.warn("odd channel data length, {}".format(data))
+		values = [notes[i:i+2] for i in range(0, len(notes) - 1, 2)]
+		return len(values), {slot: value for slot, value in enumerate(values) if value != "00"}
+
+	# read an edited chart & parse the channels whose lines changed
+	# returns the measures with changed channels & the first measure with a changed tempo channel
+	# or None if anything other than channels changed
+	def update_channels(self, chart_file):
+		self.log("Reading {}...".format(chart_file))
+		chart_headers, channel_lines, num_lines = split_chart_lines(chart_file)
+		if chart_headers != self.chart_headers:
+			return None
+		changed_headers = [header for header in channel_lines if channel_lines[header] != self.channel_lines.get(header)]
+		changed_headers += [header for header in self.channel_lines if header not in channel_lines]
+		self.channel_lines = channel_lines
+		self.num_lines = num_lines
+
+		changed_measures = set()
+		tempo_measure = None
+		data_channels = self.get_data_channels()
+		playable_channels = self.get_playable_channel_set()
+		for header in changed_headers:
+			measure = int(header[0:3])
+			changed_measures.add(measure)
+			if header[3:5] in TEMPO_CHANNELS and (tempo_measure == None or measure < tempo_measure):
+				tempo_measure = measure
+			if header in self.notes_dict:
+				del self.notes_dict[header]
+			for data in channel_lines.get(header, []):
+				self.add_channel(header, data, data_channels, playable_channels)
+
+		# find the measure lengths & the largest measure again from all channels
+		self.measurelen_dict = {}
+		self.max_measure = 0
+		for header in channel_lines:
+			measure = int(header[0:3])
+			if measure > self.max_measure:
+				self.max_measure = measure
+			if header[3:5] == MEASURE_LEN_CHANNEL:
+				for data in channel_lines[header]:
+					self.measurelen_dict[measure] = float(data)
+		self.max_measure += 1
+		self.num_notes = self.count_notes()
+		return changed_measures, tempo_measure
+
+	# channels with a data array in the current parsing mode
+	def get_data_channels(self):
+		if self.parsing_mode == MODE_DTX:
+			return DTX_DATA_CHANNELS
+		return BMS_DATA_CHANNELS
+
+	# channels whose notes are keysounds in the current parsing mode
+	def get_playable_channels(self):
+		if self.parsing_mode == MODE_DTX:
+			return DTX_PLAYABLE_CHANNELS
+		return BMS_PLAYABLE_CHANNELS
+
+	# playable channels of the current parsing mode as a set, for membership tests
+	def get_playable_channel_set(self):
+		if self.parsing_mode == MODE_DTX:
+			return DTX_PLAYABLE_CHANNEL_SET
+		return BMS_PLAYABLE_CHANNEL_SET
+
+	# save the data of a channel
+	def add_channel(self, header, data, data_channels, playable_channels):
 		measure = int(header[0:3])
 		channel = header[3:5]
-		data = re_match.group(3)
-		
+
 		# set the largest measure found
-		if measure > max_measure:
-			max_measure = measure
-		
-		if parsing_mode == MODE_BMS:
-			playable_channels = BMS_PLAYABLE_CHANNELS
-		elif parsing_mode == MODE_DTX:
-			playable_channels = DTX_PLAYABLE_CHANNELS
+		if measure > self.max_measure:
+			self.max_measure = measure
 
 		# check for channel with data array
-		if channel in (playable_channels + (BPM_CHANNEL, EXTBPM_CHANNEL, STOP_CHANNEL)) and data != "00":
-			data_array = data_to_array(data)
+		if channel in data_channels and data != "00":
+			channel_data = self.data_to_notes(data)
+			if channel in playable_channels:
+				# probe keysounds when a note first refers to them
+				new_keysounds = set(channel_data[1].values()) - self.referenced_keysounds
+				self.referenced_keysounds.update(new_keysounds)
+				if not self.probe_unused:
+					for keysound in new_keysounds:
+						if keysound in self.keysound_dict:
+							self.submit_probe(keysound)
 			if channel == "01":
 				# bgm tracks are special and shouldn't be merged
-				# dictionary maps to array of arrays instead
-				if header not in notes_dict:
-					notes_dict[header] = []
-				notes_dict[header].append(data_array)
+				# dictionary maps to a list of channel data instead
+				if header not in self.notes_dict:
+					self.notes_dict[header] = []
+				self.notes_dict[header].append(channel_data)
 			else:
 				# merge duplicate notes
-				if header in notes_dict:
-					old_data = notes_dict[header]
-					notes_dict[header] = update_data(old_data, data_array)
+				if header in self.notes_dict:
+					old_data = self.notes_dict[header]
+					self.notes_dict[header] = update_data(old_data, channel_data)
 				else:
-					notes_dict[header] = data_array
+					self.notes_dict[header] = channel_data
 		# measure length channel
 		elif channel == MEASURE_LEN_CHANNEL:
-			measurelen_dict[measure] = float(data)
-
-# for 1 measure, convert a beat position into a time offset within the measure
-# accounting for bpms & stops
-def measure_offset_seconds(start_measure, beatpos, bpmpos_array, stop_positions, measure_len):
-	bpmpos = bpmpos_array[0]
-	bpm = bpm_dict[bpmpos]
-	if bpmpos < start_measure:
-		bpmpos = start_measure
-	
-	# add time between bpm markers
-	current_time = 0
-	for i in range(1, len(bpmpos_array)):
-		next_bpmpos = bpmpos_array[i]
-		if beatpos > next_bpmpos:
-			current_time += (next_bpmpos - bpmpos) * MPS_FACTOR * measure_len / bpm
-		else:
-			break
-		bpmpos = next_bpmpos
-		bpm = bpm_dict[bpmpos]
-		
-	# add stops - extra time in the measure
-	# there's probably a more elegant way to add stops but w/e
-	stop_bpmpos_i = 0
-	for s in range(len(stop_positions)):
-		current_stop_pos = stop_positions[s]
-		if beatpos > current_stop_pos:
-			stop_bpmpos = bpmpos_array[stop_bpmpos_i]
-			stop_bpm = bpm_dict[stop_bpmpos]
-			for i in range(stop_bpmpos_i + 1, len(bpmpos_array)):			
-				next_bpmpos = bpmpos_array[i]
-				if current_stop_pos < next_bpmpos:
-					stop_bpmpos_i = i - 1
-					break
-				stop_bpmpos = next_bpmpos
-				stop_bpm = bpm_dict[stop_bpmpos]
-			current_time += stop_lengths[current_stop_pos] * MPS_FACTOR / stop_bpm
-		else:
-			break
+			self.measurelen_dict[measure] = float(data)
+
+	# given a channel, get the measure & beat position of each keysound note
+	def gather_notes(self, channel, channel_data, measure_num, notes):
+		note_channels, note_keysounds, note_measures, note_beats = notes
+		keysound_dict = self.keysound_dict
+		resolution, keysounds = channel_data
+		for slot, keysound in keysounds.items():
+			if keysound in keysound_dict:
+				note_channels.append(channel)
+				note_keysounds.append(keysound)
+				note_measures.append(measure_num)
+				note_beats.append(measure_num + slot/resolution)
 
-	# add remaining time based on last bpm marker
-	current_time += (beatpos - bpmpos) * MPS_FACTOR * measure_len / bpm
-	
-	return current_time
-
-# given a channel, get keysound samples & set their time position & length
-def add_keysounds_to_sample_dict(channel, keysounds, keysound_lengths, current_timepos, current_bpmpos_i, stop_positions, measure_num, measure_len):
-	global sample_dict, channelsample_dict
-	keysounds_len = len(keysounds)
-	for k in range(len(keysounds)):
-		keysound = keysounds[k]
-		if keysound in keysound_lengths:
+	# create keysound samples from notes & their time positions
+	def add_samples(self, note_channels, note_keysounds, note_times):
+		keysound_lengths = self.keysound_lengths
+		keysound_ids = self.keysound_ids
+		channel_ids = self.channel_ids
+		sample_dict = self.sample_dict
+		channelsample_dict = self.channelsample_dict
+		sample_keysound = self.sample_keysound
+		sample_channel = self.sample_channel
+		first_sample = len(self.sample_pos)
+		self.sample_pos.extend(note_times)
+		self.sample_length.extend([keysound_lengths[keysound] for keysound in note_keysounds])
+		for sample, channel, keysound in zip(range(first_sample, len(self.sample_pos)), note_channels, note_keysounds):
 			if keysound not in sample_dict:
-				sample_dict[keysound] = []
+				sample_dict[keysound] = array("l")
+				keysound_ids[keysound] = len(self.id_keysounds)
+				self.id_keysounds.append(keysound)
 			if channel not in channelsample_dict:
-				channelsample_dict[channel] = []
-			sample = {}
-			sample["length"] = keysound_lengths[keysound]
-			sample["pos"] = current_timepos + measure_offset_seconds(measure_num, measure_num + k/keysounds_len, bpm_positions[current_bpmpos_i:], stop_positions, measure_len)
-			sample["index"] = keysound
-			# unused but good for debugging
-			# sample["channel"] = channel
-			# sample["measure_num"] = measure_num
+				channelsample_dict[channel] = array("l")
+				channel_ids[channel] = len(self.id_channels)
+				self.id_channels.append(channel)
 			# TODO per-sample volume
-			#sample["volume"] = 1.0
+			sample_keysound.append(keysound_ids[keysound])
+			sample_channel.append(channel_ids[channel])
 			sample_dict[keysound].append(sample)
 			channelsample_dict[channel].append(sample)
 
-# for sorting the sample array by the sample position
-def sample_pos_sort_key(s):
-	return s["pos"]
-
-# primary keysound parsing & rpp generating function
-def parse_keysounds(chart_file, out_file):
-	global keysound_dict, keysound_indices, extbpm_dict, bpm_dict, bpm_positions, stop_lengths, note_dict, max_measure, sample_dict, channelsample_dict
-	
-	# master volume of the chart, default to 100.0
-	master_volume = 100.0
-	
-	# default 120 chart bpm
-	chart_bpm = 120.0
-	
-	# read bms chart
-	# assuming shift-jis encoding
-	print("Reading {}...".format(chart_file))
-	with open(chart_file, "r", encoding="shift_jis") as chart:
-		for line in chart:
-			if line.find("#") == 0:
-				line_strip = line.strip()
-				
-				# locate chart bpm
-				data = get_tag_value(line_strip, "BPM")
-				if data != None:
-					# beats (measures) start at 1, not 0
-					try:
-						chart_bpm = float(data)
-					except:
-						print("Warning: invalid #BPM value {}".format(data))
-						continue
-					bpm_dict[0.0] = chart_bpm
-					bpm_positions = [0.0]
-					bpmtime_dict[0.0] = 0
-					continue
-				
-				# locate & set master volume
-				data = get_tag_value(line_strip, "VOLWAV")
-				if data != None:
-					try:
-						master_volume = float(data)
-					except:
-						print("Warning: invalid #VOLWAV value {}".format(data))
-					continue
-				
-				# check lntype (only type 1 supported)
-				data = get_tag_value(line_strip, "LNTYPE")
-				if data != None:
-					try:
-						if int(data) != 1:
-							print("Warning: unsupported #LNTYPE {}, only #LNTYPE 1 is supported".format(data))
-					except:
-						print("Warning: invalid #LNTYPE value {}, only #LNTYPE 1 is supported".format(data))
-				
-				# locate other bms data
-				if add_keysound(line):
-					continue
-				if add_bpmvalue(line):
-					continue
-				if parsing_mode == MODE_DTX:
-					if add_keysoundvolume(line):
-						continue
-					if add_keysoundpan(line):
-						continue
-				elif parsing_mode == MODE_BMS:
-					if add_stopvalue(line):
-						continue
-				add_channel(line)
-				
-	if len(bpm_dict) == 0:
-		print("ERROR: no #BPM detected")
-		usage()
+	# whether to use numpy for count notes or samples
+	# once numpy is imported it's used for every chart, before that only for large ones
+	def numpy_for(self, count):
+		return self.use_numpy and (numpy != None or count >= NUMPY_MIN_NOTES) and import_numpy() != None
 
-	# increase maximum measure by 1, in case there are notes in the last measure
-	max_measure += 1
+	# order every sample by position, samples at the same position in the order they were added
+	# samples are added measure by measure & channel by channel, so they're already in ordered runs
+	# that one stable sort merges
+	# for DTX, samples at the same position go in the order their channels first appeared,
+	# which is the order guitar & bass samples are trimmed in
+	def build_timeline(self):
+		self.numpy_timeline = self.numpy_for(len(self.sample_pos))
+		if self.numpy_timeline:
+			sample_pos = numpy.frombuffer(self.sample_pos, dtype=numpy.float64)
+			if self.parsing_mode == MODE_DTX:
+				# lexsort is stable & sorts by its last key first
+				self.timeline = numpy.lexsort((numpy.frombuffer(self.sample_channel, dtype=numpy.dtype("l")), sample_pos))
+			else:
+				self.timeline = numpy.argsort(sample_pos, kind="stable")
+		elif self.parsing_mode == MODE_DTX:
+			sample_pos = self.sample_pos
+			sample_channel = self.sample_channel
+			self.timeline = sorted(range(len(sample_pos)), key=lambda sample: (sample_pos[sample], sample_channel[sample]))
+		else:
+			self.timeline = sorted(range(len(self.sample_pos)), key=self.sample_pos.__getitem__)
 
-	# compute lengths of each keysound
-	print("Getting keysound lengths...")
-	print("This will take a while if the keysounds are not WAV")
-	keysound_lengths = {}
-	for keysound in keysound_dict:
-		keysound_file = keysound_dict[keysound]
-		try:
-			sound = AudioSegment.from_file(keysound_file)
-		except:
-			print("ERROR: Could not load keysound file {}. If not WAV, missing ffmpeg/avconv?".format(keysound_file))
-			usage()
-		keysound_lengths[keysound] = sound.frame_count() / sound.frame_rate
-		
-	# current time position in seconds, starting at 0
-	current_timepos = 0
-	# current bpm position index, starting at 0
-	current_bpmpos_i = 0
-	# read keysounds, measure by measure
-	print("Processing keysounds...")
-	for measure_num in range(max_measure):
-		# get length of this measure
-		if measure_num in measurelen_dict:
-			measure_len = measurelen_dict[measure_num]
-			# set initial measurelen time, if any
-			if measure_num == 0:
-				measurelentime_dict[0] = 0
+	# split the timeline by a column of sample ids, e.g. sample_keysound
+	# id_groups optionally maps each id to a group id, to put several ids in one group
+	# returns a dictionary of group id to lists of sample numbers in timeline order
+	def split_timeline(self, sample_ids, id_groups=None):
+		if self.numpy_timeline:
+			# group with a stable sort, so each group stays in timeline order
+			timeline_ids = numpy.array(sample_ids, dtype=numpy.int64)[self.timeline]
+			if id_groups != None:
+				timeline_ids = numpy.array(id_groups, dtype=numpy.int64)[timeline_ids]
+			order = numpy.argsort(timeline_ids, kind="stable")
+			group_ids, group_starts = numpy.unique(timeline_ids[order], return_index=True)
+			group_samples = numpy.split(self.timeline[order], group_starts[1:])
+			return dict(zip(group_ids.tolist(), [samples.tolist() for samples in group_samples]))
+		groups = {}
+		for sample in self.timeline:
+			group_id = sample_ids[sample]
+			if id_groups != None:
+				group_id = id_groups[group_id]
+			if group_id in groups:
+				groups[group_id].append(sample)
+			else:
+				groups[group_id] = [sample]
+		return groups
+
+	# cut the lengths of samples that overlap the next sample, in sorted sample numbers
+	def trim_overlaps(self, samples):
+		sample_pos = self.sample_pos
+		sample_length = self.sample_length
+		for s in range(len(samples) - 1):
+			sample = samples[s]
+			next_sample = samples[s+1]
+			if sample_pos[sample] + sample_length[sample] > sample_pos[next_sample]:
+				sample_length[sample] = sample_pos[next_sample] - sample_pos[sample]
+
+	# read the chart & locate all header & channel data
+	# headers & channels are handled line by line, so keysounds start being probed while the chart is still being read
+	def read_chart(self, chart_file):
+		self.log("Reading {}...".format(chart_file))
+		self.chart_headers = []
+		self.channel_lines = {}
+		self.keysound_index = get_keysound_index(self.chart_dir)
+		# indexed headers of the current parsing mode
+		if self.parsing_mode == MODE_DTX:
+			header_handlers = {"WAV": self.add_keysound, "BPM": self.add_bpmvalue,
+								"VOLUME": self.add_keysoundvolume, "PAN": self.add_keysoundpan}
 		else:
-			measure_len = 1
-		
-		# number of bpms in measure, including bpm from before the measure
-		bpms_in_measure = 1
-		
-		# number of new bpms added
-		num_bpms_added = 0
-		
-		# locate stops in the measure, get their positions & compute their lengths
-		stop_header = "{:03d}{}".format(measure_num, STOP_CHANNEL)
-		stop_positions = []
-		if stop_header in notes_dict:
-			stop_indices = notes_dict[stop_header]
-			stop_arraylen = len(stop_indices)
-			for s in range(stop_arraylen):
-				if stop_indices[s] != "00":
+			header_handlers = {"WAV": self.add_keysound, "BPM": self.add_bpmvalue,
+								"STOP": self.add_stopvalue}
+		data_channels = self.get_data_channels()
+		playable_channels = self.get_playable_channel_set()
+
+		def add_header(name, index, value):
+			self.chart_headers.append((name, index, value))
+			if index == None:
+				self.set_tag(name, value)
+			else:
+				handler = header_handlers.get(name)
+				if handler != None:
+					handler(index, value)
+
+		def add_data(header, data):
+			add_channel_line(self.channel_lines, header, data)
+			self.add_channel(header, data, data_channels, playable_channels)
+
+		self.num_lines = read_chart_lines(chart_file, add_header, add_data)
+
+		if len(self.bpm_dict) == 0:
+			raise ConversionError("no #BPM detected")
+
+		# increase maximum measure by 1, in case there are notes in the last measure
+		self.max_measure += 1
+		self.num_notes = self.count_notes()
+
+	# read the chart from the chart cache if it's there & its keysounds haven't changed
+	# otherwise read the chart, & remember its key to save it to the cache once it's converted
+	# returns whether it was found in the cache
+	# with keep_track_items the chart is always read, so reconvert() has parsed channels to update after an edit
+	def read_cached_chart(self, chart_file):
+		if self.chart_cache_dir != None:
+			try:
+				self.chart_cache_key = get_chart_cache_key(chart_file, self.keysound_exts, self.probe_unused)
+			except OSError as e:
+				raise ConversionError("Could not read {}: {}".format(chart_file, e))
+			if not self.keep_track_items and self.load_chart_cache(get_chart_cache_path(self.chart_cache_dir, self.chart_cache_key)):
+				return True
+		self.read_chart(chart_file)
+		return False
+
+	# load a compiled chart, returns False if it's missing, unreadable or out of date
+	def load_chart_cache(self, cache_file):
+		try:
+			with open(cache_file, "rb") as cache:
+				data = cache.read()
+			magic, version, state_size, num_samples = CHART_CACHE_HEADER.unpack_from(data, 0)
+			if magic != CHART_CACHE_MAGIC or version != CHART_CACHE_VERSION:
+				return False
+			pos = CHART_CACHE_HEADER.size
+			state = json.loads(data[pos:pos + state_size].decode("utf-8", "surrogateescape"))
+			pos += state_size
+			columns = []
+			for typecode, size, count in (("d", 8, num_samples), ("d", 8, num_samples), ("q", 8, num_samples),
+					("q", 8, num_samples), ("q", 8, len(state["id_keysounds"])), ("q", 8, num_samples)):
+				columns.append(array_from_bytes(typecode, data[pos:pos + size * count]))
+				pos += size * count
+			if pos != len(data):
+				return False
+		except (OSError, ValueError, KeyError, struct.error):
+			return False
+
+		# the keysounds must be found as the same files, unchanged, & the extracted oggs must still be there
+		try:
+			keysound_index = get_keysound_index(self.chart_dir)
+			for value, keysound_filename in state["keysound_lookups"]:
+				if keysound_index.find(value, self.keysound_exts) != keysound_filename:
+					return False
+			for keysound_key in state["keysound_keys"].values():
+				if list(get_keysound_key(keysound_key[0])) != keysound_key:
+					return False
+		except (OSError, KeyError, TypeError, ValueError):
+			return False
+		if not all(os.path.isfile(ogg_file) for ogg_file in state["chunked_oggs"].values()):
+			return False
+
+		self.log("Reading compiled chart {}...".format(cache_file))
+		self.chart_bpm = state["chart_bpm"]
+		self.master_volume = state["master_volume"]
+		self.num_lines = state["num_lines"]
+		self.num_notes = state["num_notes"]
+		self.bpm_positions = state["bpm_positions"]
+		self.bpm_dict = {}
+		self.bpmtime_dict = {}
+		for bpm_pos, bpm, bpmtime in state["bpm_points"]:
+			self.bpm_dict[bpm_pos] = bpm
+			self.bpmtime_dict[bpm_pos] = bpmtime
+		self.measurelen_dict = {}
+		self.measurelentime_dict = {}
+		for measurelen_pos, measurelen, measurelentime in state["measure_lengths"]:
+			self.measurelen_dict[measurelen_pos] = measurelen
+			self.measurelentime_dict[measurelen_pos] = measurelentime
+		self.keysound_dict = state["keysound_dict"]
+		self.keysound_indices = state["keysound_indices"]
+		self.keysound_lookups = [tuple(lookup) for lookup in state["keysound_lookups"]]
+		self.keysound_keys = {keysound: tuple(keysound_key) for keysound, keysound_key in state["keysound_keys"].items()}
+		self.keysound_lengths = state["keysound_lengths"]
+		self.keysoundvol_dict = state["keysoundvol_dict"]
+		self.keysoundpan_dict = state["keysoundpan_dict"]
+		self.chunked_oggs = state["chunked_oggs"]
+		self.id_keysounds = state["id_keysounds"]
+		self.keysound_ids = {keysound: keysound_id for keysound_id, keysound in enumerate(self.id_keysounds)}
+		self.id_channels = state["id_channels"]
+		self.channel_ids = {channel: channel_id for channel_id, channel in enumerate(self.id_channels)}
+
+		sample_pos, sample_length, sample_keysound, sample_channel, timeline_lengths, timeline_samples = columns
+		self.sample_pos = sample_pos
+		self.sample_length = sample_length
+		self.sample_keysound = array("l", sample_keysound)
+		self.sample_channel = array("l", sample_channel)
+		self.sample_dict = {keysound: array("l") for keysound in self.id_keysounds}
+		self.channelsample_dict = {channel: array("l") for channel in self.id_channels}
+		for sample, keysound_id, channel_id in zip(range(len(sample_pos)), self.sample_keysound, self.sample_channel):
+			self.sample_dict[self.id_keysounds[keysound_id]].append(sample)
+			self.channelsample_dict[self.id_channels[channel_id]].append(sample)
+		self.keysound_timelines = {}
+		start = 0
+		for keysound_id, timeline_length in enumerate(timeline_lengths):
+			self.keysound_timelines[keysound_id] = timeline_samples[start:start + timeline_length].tolist()
+			start += timeline_length
+		for message in state["warnings"]:
+			self.warn(message)
+		self.from_chart_cache = True
+		# keep the cache file from being evicted
+		try:
+			os.utime(cache_file)
+		except OSError:
+			pass
+		return True
+
+	# save the trimmed samples, tempo map & everything else the rpp is written from, to the chart cache
+	# with the keysound lookups & the metadata of the keysounds found
+	def save_chart_cache(self):
+		cache_file = get_chart_cache_path(self.chart_cache_dir, self.chart_cache_key)
+		state = {
+			"chart_bpm": self.chart_bpm,
+			"master_volume": self.master_volume,
+			"num_lines": self.num_lines,
+			"num_notes": self.num_notes,
+			"bpm_positions": self.bpm_positions,
+			"bpm_points": [(bpm_pos, self.bpm_dict[bpm_pos], self.bpmtime_dict[bpm_pos]) for bpm_pos in self.bpm_positions],
+			"measure_lengths": [(measurelen_pos, self.measurelen_dict[measurelen_pos], self.measurelentime_dict[measurelen_pos])
+				for measurelen_pos in self.measurelentime_dict],
+			"keysound_dict": self.keysound_dict,
+			"keysound_indices": self.keysound_indices,
+			"keysound_lookups": self.keysound_lookups,
+			"keysound_keys": self.keysound_keys,
+			"keysound_lengths": self.keysound_lengths,
+			"keysoundvol_dict": self.keysoundvol_dict,
+			"keysoundpan_dict": self.keysoundpan_dict,
+			"chunked_oggs": self.chunked_oggs,
+			"id_keysounds": self.id_keysounds,
+			"id_channels": self.id_channels,
+			"warnings": self.warnings,
+		}
+		state_bytes = json.dumps(state).encode("utf-8", "surrogateescape")
+		timeline_lengths = array("q", [len(self.keysound_timelines.get(keysound_id, [])) for keysound_id in range(len(self.id_keysounds))])
+		timeline_samples = array("q")
+		for keysound_id in range(len(self.id_keysounds)):
+			timeline_samples.extend(self.keysound_timelines.get(keysound_id, []))
+		temp_file = get_temp_file(cache_file)
+		try:
+			os.makedirs(self.chart_cache_dir, exist_ok=True)
+			with open(temp_file, "wb") as cache:
+				cache.write(CHART_CACHE_HEADER.pack(CHART_CACHE_MAGIC, CHART_CACHE_VERSION, len(state_bytes), len(self.sample_pos)))
+				cache.write(state_bytes)
+				for column in (self.sample_pos, self.sample_length, array("q", self.sample_keysound), array("q", self.sample_channel),
+						timeline_lengths, timeline_samples):
+					cache.write(array_to_bytes(column))
+			os.replace(temp_file, cache_file)
+		except OSError as e:
+			self.log("Warning: could not save compiled chart, {}".format(e))
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+
+	# look up a keysound in memory & in the keysound cache, or probe it if it's in neither
+	# runs on the probe pool, returns the keysound key, its info & whether it was probed
+	def lookup_keysound(self, keysound_path):
+		key = get_keysound_key(keysound_path)
+		info = self.keysound_memo.get(key)
+		if info == None and self.keysound_cache != None:
+			info = self.keysound_cache.get(key)
+		# extract chunked vorbis wavs again if their ogg is gone
+		if info != None and info[3] and not os.path.isfile(get_chunked_ogg_path(self.chunked_ogg_dir, key)):
+			info = None
+		if info != None:
+			return key, info, False
+		return key, probe_keysound(keysound_path, get_chunked_ogg_path(self.chunked_ogg_dir, key)), True
+
+	# start looking up a keysound on the probe pool, so it's probed while the rest of the chart is parsed
+	# keysounds of the same file share one lookup
+	# probing is mostly file i/o or waiting on ffmpeg, so threads are enough
+	def submit_probe(self, keysound):
+		keysound_path = self.get_keysound_path(self.keysound_dict[keysound])
+		future = self.probe_paths.get(keysound_path)
+		if future == None:
+			if self.probe_pool == None:
+				from concurrent.futures import ThreadPoolExecutor
+				self.probe_pool = ThreadPoolExecutor(max_workers=self.probe_jobs)
+			future = self.probe_pool.submit(self.lookup_keysound, keysound_path)
+			self.probe_paths[keysound_path] = future
+		self.probe_futures[keysound] = future
+
+	# stop the probe pool, dropping the lookups that haven't started
+	def shutdown_probes(self):
+		if self.probe_pool != None:
+			for future in self.probe_paths.values():
+				future.cancel()
+			self.probe_pool.shutdown(wait=False)
+			self.probe_pool = None
+
+	# wait for the keysound lookups started while reading, & get the keysound lengths
+	def get_keysound_lengths(self):
+		self.log("Getting keysound lengths...")
+		keysound_cache = self.keysound_cache
+		keysound_memo = self.keysound_memo
+		if len(keysound_memo) > KEYSOUND_MEMO_MAX_ENTRIES:
+			keysound_memo.clear()
+		failed_files = []
+		for keysound, future in self.probe_futures.items():
+			try:
+				key, info, probed = future.result()
+			except:
+				failed_files.append(self.keysound_dict[keysound])
+				continue
+			keysound_memo[key] = info
+			self.keysound_keys[keysound] = key
+			if probed and keysound_cache != None:
+				keysound_cache.put(key, info)
+			self.keysound_lengths[keysound] = info[0]
+			if info[3]:
+				self.chunked_oggs[keysound] = get_chunked_ogg_path(self.chunked_ogg_dir, key)
+		self.probe_futures = {}
+		self.probe_paths = {}
+		if self.probe_pool != None:
+			self.probe_pool.shutdown()
+			self.probe_pool = None
+		if keysound_cache != None:
+			keysound_cache.flush()
+
+		if len(failed_files) != 0:
+			raise ConversionError("\n".join("Could not load keysound file {}. If not WAV/OGG/MP3, missing ffmpeg/avconv?".format(keysound_file) for keysound_file in failed_files))
+		num_skipped = self.count_skipped_keysounds()
+		if num_skipped > 0:
+			self.log("Skipped {} keysounds that no note refers to".format(num_skipped))
+		if len(self.chunked_oggs) > 0:
+			self.log("Using {} oggs extracted from chunked vorbis wavs".format(len(self.chunked_oggs)))
+
+	# compute time positions of bpms, measures & keysound samples
+	def compute_timing(self):
+		self.log("Processing keysounds...")
+		self.compute_tempo()
+		self.measure_notes = {}
+		self.time_measures(range(self.max_measure))
+
+	# compute time positions of bpms & measures, & build the tempo map
+	def compute_tempo(self):
+		# start from the chart bpm, as the tempo is computed again after edits
+		self.bpm_dict = {0.0: self.chart_bpm}
+		self.bpm_positions = [0.0]
+		self.bpmtime_dict = {0.0: 0}
+		self.stop_lengths = {}
+		self.measurelentime_dict = {}
+		# bpm positions added in each measure
+		new_bpm_positions = []
+		for measure_num in range(self.max_measure):
+			# locate stops in the measure, get their positions & compute their lengths
+			stop_header = "{:03d}{}".format(measure_num, STOP_CHANNEL)
+			if stop_header in self.notes_dict:
+				stop_resolution, stop_indices = self.notes_dict[stop_header]
+				for s, stop_index in stop_indices.items():
 					# found stop
-					stop_position = measure_num + s / stop_arraylen
-					stop_positions.append(stop_position)
-					stop_length = stop_dict[stop_indices[s]] / 192.0
-					stop_lengths[stop_position] = stop_length
-		
-		# locate bpms in the measure, get their positions
-		bpm_header = "{:03d}{}".format(measure_num, BPM_CHANNEL)
-		if bpm_header in notes_dict:
-			bpm_hex = notes_dict[bpm_header]
-			bpm_arraylen = len(bpm_hex)
-			for b in range(bpm_arraylen):
-				if bpm_hex[b] != "00":
-					# found bpm, add to bpm_dict
-					bpm_pos = measure_num + b/bpm_arraylen
-					num_bpms_added += 1
-					if b != 0: # added another bpm to measure
-						bpms_in_measure += 1
-					else: # b == 0, replaces the previous bpm for the measure. update current_bpmpos_i
-						current_bpmpos_i += 1
-					bpm_positions.append(bpm_pos)
-					bpm_dict[bpm_pos] = int("0x" + bpm_hex[b],16)
-		
-		# locate extended bpms in the measure, get their values & positions
-		extbpm_header = "{:03d}{}".format(measure_num, EXTBPM_CHANNEL)
-		if extbpm_header in notes_dict:
-			extbpm_indices = notes_dict[extbpm_header]
-			extbpm_arraylen = len(extbpm_indices)
-			for b in range(extbpm_arraylen):
-				if extbpm_indices[b] in extbpm_dict:
-					# found bpm, add to bpm_dict
-					bpm_pos = measure_num + b/extbpm_arraylen
-					if bpm_pos in bpm_dict:
-						print("Warning: overwrote BPM at position {}".format(bpm_pos))
-					else:
-						num_bpms_added += 1
-						if b != 0: # added another bpm to measure
-							bpms_in_measure += 1
-						else: # b == 0, replaces the previous bpm for the measure. update current_bpmpos_i
-							current_bpmpos_i += 1
-						bpm_positions.append(bpm_pos)
-					# handle negative bpm?
-					bpm_dict[bpm_pos] = abs(extbpm_dict[extbpm_indices[b]])
-		
+					stop_position = measure_num + s / stop_resolution
+					stop_length = self.stop_dict[stop_index] / 192.0
+					self.stop_lengths[stop_position] = stop_length
+
+			# locate bpms in the measure, get their positions
+			bpm_header = "{:03d}{}".format(measure_num, BPM_CHANNEL)
+			if bpm_header in self.notes_dict:
+				bpm_resolution, bpm_hex = self.notes_dict[bpm_header]
+				for b, bpm_value in bpm_hex.items():
+					# found bpm, add to self.bpm_dict
+					bpm_pos = measure_num + b/bpm_resolution
+					new_bpm_positions.append((measure_num, bpm_pos))
+					self.bpm_positions.append(bpm_pos)
+					self.bpm_dict[bpm_pos] = int("0x" + bpm_value,16)
+
+			# locate extended bpms in the measure, get their values & positions
+			extbpm_header = "{:03d}{}".format(measure_num, EXTBPM_CHANNEL)
+			if extbpm_header in self.notes_dict:
+				extbpm_resolution, extbpm_indices = self.notes_dict[extbpm_header]
+				for b, extbpm_index in extbpm_indices.items():
+					if extbpm_index in self.extbpm_dict:
+						# found bpm, add to self.bpm_dict
+						bpm_pos = measure_num + b/extbpm_resolution
+						if bpm_pos in self.bpm_dict:
+							self.warn("overwrote BPM at position {}".format(bpm_pos))
+						else:
+							new_bpm_positions.append((measure_num, bpm_pos))
+							self.bpm_positions.append(bpm_pos)
+						# handle negative bpm?
+						self.bpm_dict[bpm_pos] = abs(self.extbpm_dict[extbpm_index])
+
 		# sort bpm positions
-		bpm_positions.sort()
-		
-		# compute time offsets for new bpm markers in measure
-		for bpmpos_i in range(len(bpm_positions) - num_bpms_added, len(bpm_positions)):
-			bpm_pos = bpm_positions[bpmpos_i]
-			bpmtime_dict[bpm_pos] = current_timepos + measure_offset_seconds(measure_num, bpm_pos, bpm_positions[current_bpmpos_i:], stop_positions, measure_len)
-		
-		# get each channel's keysounds
-		if parsing_mode == MODE_BMS:
-			playable_channels = BMS_PLAYABLE_CHANNELS
-		elif parsing_mode == MODE_DTX:
-			playable_channels = DTX_PLAYABLE_CHANNELS
-		
-		for channel in playable_channels:
-			header = "{:03d}{}".format(measure_num, channel)
-			if header in notes_dict:
-				if channel == "01":
-					# multiple bgm keysound arrays
-					for keysounds in notes_dict[header]:
-						add_keysounds_to_sample_dict(channel, keysounds, keysound_lengths, current_timepos, current_bpmpos_i, stop_positions, measure_num, measure_len)
-				else:
-					keysounds = notes_dict[header]
-					add_keysounds_to_sample_dict(channel, keysounds, keysound_lengths, current_timepos, current_bpmpos_i, stop_positions, measure_num, measure_len)
-		
-		# move current time to next measure
-		current_timepos += measure_offset_seconds(measure_num, measure_num + 1, bpm_positions[current_bpmpos_i:], stop_positions, measure_len)
-
-		# if there's a next measurelen marker, set its time position
-		if measure_num + 1 in measurelen_dict:
-			measurelentime_dict[measure_num + 1] = current_timepos
-		# if the current measure_len isn't 4/4, add a new 4/4 measurelen marker for the next measure
-		elif measure_len != 1:
-			measurelen_dict[measure_num + 1] = 1.0
-			measurelentime_dict[measure_num + 1] = current_timepos
-		current_bpmpos_i += (bpms_in_measure - 1)
-
-	# DTX-specific overlapping sample handling
-	if parsing_mode == MODE_DTX:
-		guitar_samples = []
-		bass_samples = []
-		for channel in channelsample_dict:
-			if channel in DTX_BG_CHANNELS:
-				# trim overlapping samples within each background channel
-				sample_array = channelsample_dict[channel]
-				sample_array.sort(key=sample_pos_sort_key)
-				for s in range(len(sample_array) - 1):
-					sample = sample_array[s]
-					next_sample = sample_array[s+1]
-					if sample["pos"] + sample["length"] > next_sample["pos"]:
-						sample["length"] = next_sample["pos"] - sample["pos"]
-			elif channel in DTX_GUITAR_CHANNELS:
-				guitar_samples += channelsample_dict[channel]
-			elif channel in DTX_BASS_CHANNELS:
-				bass_channels += channelsample_dict[channel]
-		# trim overlapping samples in guitar
-		guitar_samples.sort(key=sample_pos_sort_key)
-		for s in range(len(guitar_samples) - 1):
-			sample = guitar_samples[s]
-			next_sample = guitar_samples[s+1]
-			if sample["pos"] + sample["length"] > next_sample["pos"]:
-				sample["length"] = next_sample["pos"] - sample["pos"]
-		# trim overlapping samples in bass
-		bass_samples.sort(key=sample_pos_sort_key)
-		for s in range(len(bass_samples) - 1):
-			sample = bass_samples[s]
-			next_sample = bass_samples[s+1]
-			if sample["pos"] + sample["length"] > next_sample["pos"]:
-				sample["length"] = next_sample["pos"] - sample["pos"]
-	# BMS-specific long note handling
-	elif parsing_mode == MODE_BMS:
-		for channel in channelsample_dict:
-			sample_array = channelsample_dict[channel]
-			sample_array.sort(key=sample_pos_sort_key)
-			for s in range(len(sample_array)):
-				sample = sample_array[s]
+		self.bpm_positions.sort()
+
+		# build the tempo map
+		measure_lens = []
+		for measure_num in range(self.max_measure):
+			if measure_num in self.measurelen_dict:
+				measure_lens.append(self.measurelen_dict[measure_num])
+			else:
+				measure_lens.append(1)
+		self.tempo_map = TempoMap(self.bpm_positions, self.bpm_dict, self.stop_lengths, measure_lens)
+
+		# compute time offsets for new bpm markers
+		for measure_num, bpm_pos in new_bpm_positions:
+			self.bpmtime_dict[bpm_pos] = self.tempo_map.seconds(measure_num, bpm_pos)
+
+		# compute time offsets for measure length markers
+		if 0 in self.measurelen_dict:
+			self.measurelentime_dict[0] = 0
+		for measure_num in range(self.max_measure):
+			next_measure_time = self.tempo_map.measure_times[measure_num + 1]
+			# if there's a next measurelen marker, set its time position
+			if measure_num + 1 in self.measurelen_dict:
+				self.measurelentime_dict[measure_num + 1] = next_measure_time
+			# if the current measure_len isn't 4/4, add a new 4/4 measurelen marker for the next measure
+			elif measure_lens[measure_num] != 1:
+				self.measurelen_dict[measure_num + 1] = 1.0
+				self.measurelentime_dict[measure_num + 1] = next_measure_time
+
+	# gather the notes of some measures & compute their time positions into measure_notes
+	def time_measures(self, measure_nums):
+		playable_channels = self.get_playable_channels()
+		# get each channel's keysounds, measure by measure
+		notes = ([], [], [], [])
+		note_counts = []
+		for measure_num in measure_nums:
+			for channel in playable_channels:
+				header = "{:03d}{}".format(measure_num, channel)
+				if header in self.notes_dict:
+					if channel == "01":
+						# multiple bgm channels
+						for channel_data in self.notes_dict[header]:
+							self.gather_notes(channel, channel_data, measure_num, notes)
+					else:
+						self.gather_notes(channel, self.notes_dict[header], measure_num, notes)
+			note_counts.append((measure_num, len(notes[0])))
+
+		# convert every note position into seconds
+		note_channels, note_keysounds, note_measures, note_beats = notes
+		if len(note_beats) > 0 and self.numpy_for(len(note_beats)):
+			note_times = array("d", self.tempo_map.seconds_array(note_measures, note_beats).tobytes())
+		else:
+			note_times = array("d", [self.tempo_map.seconds(measure_num, beatpos) for measure_num, beatpos in zip(note_measures, note_beats)])
+
+		# split the notes by measure
+		start = 0
+		for measure_num, end in note_counts:
+			if end > start:
+				self.measure_notes[measure_num] = (note_channels[start:end], note_keysounds[start:end], note_times[start:end])
+			elif measure_num in self.measure_notes:
+				del self.measure_notes[measure_num]
+			start = end
+
+	# compute time positions again after an edit
+	# notes of changed measures & of every measure from the first tempo change are timed again
+	def retime(self, changed_measures, tempo_measure):
+		self.log("Processing keysounds...")
+		self.compute_tempo()
+		measure_nums = set(measure_num for measure_num in changed_measures if measure_num < self.max_measure)
+		if tempo_measure != None:
+			measure_nums.update(range(tempo_measure, self.max_measure))
+		# forget the notes of removed measures at the end of the chart
+		for measure_num in list(self.measure_notes):
+			if measure_num >= self.max_measure:
+				del self.measure_notes[measure_num]
+		self.time_measures(sorted(measure_nums))
+
+	# create the keysound samples of every measure's notes, in measure order
+	def build_samples(self):
+		self.sample_pos = array("d")
+		self.sample_length = array("d")
+		self.sample_keysound = array("l")
+		self.sample_channel = array("l")
+		self.keysound_ids = {}
+		self.id_keysounds = []
+		self.channel_ids = {}
+		self.id_channels = []
+		self.sample_dict = {}
+		self.channelsample_dict = {}
+		for measure_num in sorted(self.measure_notes):
+			self.add_samples(*self.measure_notes[measure_num])
+		self.timeline = []
+		self.numpy_timeline = False
+		self.keysound_timelines = {}
+
+	# create the samples with their keysound lengths, then trim overlapping samples & long notes
+	# every rule works on samples in timeline order, split by channel or keysound
+	def trim_samples(self):
+		self.build_samples()
+		sample_pos = self.sample_pos
+		sample_length = self.sample_length
+		self.build_timeline()
+		# DTX-specific overlapping sample handling
+		if self.parsing_mode == MODE_DTX:
+			# every guitar channel is one group, & every bass channel
+			channel_groups = list(range(len(self.id_channels)))
+			for channel_id, channel in enumerate(self.id_channels):
+				for group_channels in (DTX_GUITAR_CHANNELS, DTX_BASS_CHANNELS):
+					if channel in group_channels:
+						channel_groups[channel_id] = min(self.channel_ids.get(group_channel, channel_id) for group_channel in group_channels)
+			for group_id, samples in self.split_timeline(self.sample_channel, channel_groups).items():
+				channel = self.id_channels[group_id]
+				# trim overlapping samples within each background channel, in guitar & in bass
+				if channel in DTX_BG_CHANNELS or channel in DTX_GUITAR_CHANNELS or channel in DTX_BASS_CHANNELS:
+					self.trim_overlaps(samples)
+		# BMS-specific long note handling
+		elif self.parsing_mode == MODE_BMS:
+			for channel_id, sample_array in self.split_timeline(self.sample_channel).items():
+				channel = self.id_channels[channel_id]
 				if channel in LONG_NOTE_CHANNELS:
-					if channel not in active_long_notes:
-						active_long_notes[channel] = sample["index"]
-						next_sample = sample_array[s+1]
-						if sample["pos"] + sample["length"] > next_sample["pos"]:
-							sample["length"] = next_sample["pos"] - sample["pos"]
+					for s in range(len(sample_array)):
+						sample = sample_array[s]
+						keysound_index = self.id_keysounds[self.sample_keysound[sample]]
+						if channel not in self.active_long_notes:
+							self.active_long_notes[channel] = keysound_index
+							# an unterminated long note at the end of the channel plays in full
+							if s + 1 < len(sample_array):
+								next_sample = sample_array[s+1]
+								if sample_pos[sample] + sample_length[sample] > sample_pos[next_sample]:
+									sample_length[sample] = sample_pos[next_sample] - sample_pos[sample]
+						else:
+							# terminate long note
+							if keysound_index == self.active_long_notes[channel]:
+								sample_length[sample] = 0
+							del self.active_long_notes[channel]
+			if len(self.active_long_notes) != 0:
+				self.warn("unterminated long notes {}".format(self.active_long_notes))
+		self.keysound_timelines = self.split_timeline(self.sample_keysound)
+		if self.parsing_mode == MODE_BMS:
+			# cut the lengths of samples that overlap another sample of the same keysound
+			for samples in self.keysound_timelines.values():
+				self.trim_overlaps(samples)
+
+	# get the path of a keysound as written to the rpp, relative to the rpp if possible
+	# absolute if out_dir is None
+	def get_rpp_keysound_path(self, keysound_filename, out_dir):
+		keysound_path = os.path.abspath(self.get_keysound_path(keysound_filename))
+		if out_dir == None:
+			return keysound_path
+		try:
+			return os.path.relpath(keysound_path, out_dir)
+		except ValueError: # different drive on windows
+			return keysound_path
+
+	# get the rpp text of the items of sorted samples, & the number of items
+	# samples trimmed to nothing are left out
+	def format_items(self, samples, item_tail):
+		sample_pos = self.sample_pos
+		sample_length = self.sample_length
+		items = []
+		for sample in samples:
+			if sample_length[sample] > 0:
+				# add a keysound sample to the track
+				items.append("<ITEM\nPOSITION {}\nLENGTH {}\n".format(sample_pos[sample], sample_length[sample]))
+				items.append(item_tail)
+		return "".join(items), len(items) // 2
+
+	# write the rpp to a file, a gzipped file or stdout
+	def write_rpp(self, out_file):
+		self.log("Writing {}...".format(out_file))
+		start_time = time.perf_counter()
+		if out_file == RPP_STDOUT:
+			sys.stdout.flush()
+			self.rpp_bytes = write_chunks(self.generate_rpp(None), sys.stdout.buffer)
+			sys.stdout.buffer.flush()
+		else:
+			# write to a temporary file first, so the rpp is replaced all at once
+			out_dir = os.path.dirname(os.path.abspath(out_file))
+			temp_file = get_temp_file(out_file)
+			try:
+				with open(temp_file, "wb") as rpp_out:
+					if out_file.lower().endswith(GZIP_EXT):
+						with gzip.GzipFile(os.path.basename(out_file), "wb", 6, rpp_out) as gzip_out:
+							self.rpp_bytes = write_chunks(self.generate_rpp(out_dir), gzip_out)
 					else:
-						# terminate long note
-						if sample["index"] == active_long_notes[channel]:
-							sample["length"] = 0
-						del active_long_notes[channel]
-		if len(active_long_notes) != 0:
-			print("WARNING: unterminated long notes")
-			print(active_long_notes)
-	
-	# write rpp
-	print("Writing {}...".format(out_file))
-	with open(out_file, "w") as rpp_out:
-		rpp_out.write("<REAPER_PROJECT\n")
-		rpp_out.write("TEMPO {} 4 4\n".format(chart_bpm))
-		rpp_out.write("MASTERTRACKVIEW 1 0.6667 0.5 0.5 0 0 0 0 0 0\n")
-		
-		if parsing_mode == MODE_BMS:
-			# 1/3 master volume
-			rpp_out.write("MASTER_VOLUME {} 0 -1 -1 1\n".format(master_volume / 300.0))
-		elif parsing_mode == MODE_DTX:
+						self.rpp_bytes = write_chunks(self.generate_rpp(out_dir), rpp_out)
+				os.replace(temp_file, out_file)
+			except:
+				if os.path.exists(temp_file):
+					os.remove(temp_file)
+				raise
+		elapsed = time.perf_counter() - start_time
+		items_per_second = self.rpp_items / elapsed if elapsed > 0 else 0
+		self.log("Wrote {} items, {} bytes in {:.3f}s ({:.0f} items/s)".format(self.rpp_items, self.rpp_bytes, elapsed, items_per_second))
+		self.log("Done, output to {}".format(out_file))
+
+	# get the master volume of the rpp from #VOLWAV
+	def get_master_volume(self):
+		if self.parsing_mode == MODE_DTX:
 			# 1/2 master volume
-			rpp_out.write("MASTER_VOLUME {} 0 -1 -1 1\n".format(master_volume / 200.0))
-		rpp_out.write("VIDEO_CONFIG 0 0 256\n")
-		rpp_out.write("PANMODE 3\n")
-		rpp_out.write("VZOOMEX 0 0\n")
+			return self.master_volume / 200.0
+		# 1/3 master volume
+		return self.master_volume / 300.0
+
+	# get the volume & pan of a keysound's track (dtx only, bms tracks are 1 & 0)
+	def get_track_volpan(self, keysound_index):
+		if keysound_index in self.keysoundvol_dict:
+			vol = self.keysoundvol_dict[keysound_index]
+		else:
+			vol = 1.0
+		if keysound_index in self.keysoundpan_dict:
+			pan = self.keysoundpan_dict[keysound_index]
+		else:
+			pan = 0.0
+		return vol, pan
+
+	# mix the keysound samples down to a stereo wav, or flac with ffmpeg, as the rpp would play them
+	# mixed in blocks of RENDER_BLOCK_FRAMES frames, so memory depends on the block size
+	# & the samples playing at once, not the length of the chart
+	def render(self, render_file):
+		if import_numpy() == None:
+			raise ConversionError("Rendering requires numpy")
+		self.log("Rendering {}...".format(render_file))
+		start_time = time.perf_counter()
+		frame_rate = RENDER_FRAME_RATE
+		if self.decoded_keysounds == None:
+			self.decoded_keysounds = DecodedKeysoundCache(frame_rate)
+		decoded_keysounds = self.decoded_keysounds
+
+		# left & right gain of each keysound id, the track volume & pan times the master volume
+		# pan is a balance, as with PANMODE 3 on a stereo source
+		master_volume = self.get_master_volume()
+		gains = []
+		keysound_files = []
+		for keysound in self.id_keysounds:
+			vol, pan = self.get_track_volpan(keysound)
+			gains.append((vol * master_volume * min(1.0, 1.0 - pan), vol * master_volume * min(1.0, 1.0 + pan)))
+			if keysound in self.chunked_oggs:
+				keysound_files.append(self.chunked_oggs[keysound])
+			else:
+				keysound_files.append(self.get_keysound_path(self.keysound_dict[keysound]))
+		gains = numpy.array(gains, dtype=numpy.float32).reshape(-1, RENDER_CHANNELS)
+
+		# samples by start frame, samples trimmed to nothing left out
+		sample_starts = numpy.rint(numpy.array(self.sample_pos, dtype=numpy.float64) * frame_rate).astype(numpy.int64)
+		sample_lengths = numpy.rint(numpy.array(self.sample_length, dtype=numpy.float64) * frame_rate).astype(numpy.int64)
+		samples = numpy.flatnonzero(sample_lengths > 0)
+		samples = samples[numpy.argsort(sample_starts[samples], kind="stable")]
+		voice_starts = sample_starts[samples].tolist()
+		voice_lengths = sample_lengths[samples].tolist()
+		voice_keysounds = numpy.array(self.sample_keysound, dtype=numpy.int64)[samples].tolist()
+		end_frame = max((start + length for start, length in zip(voice_starts, voice_lengths)), default=0)
+
+		temp_file = get_temp_file(render_file)
+		writer = RenderWriter(temp_file, os.path.splitext(render_file)[1].lower() == FLAC_EXT, frame_rate)
+		try:
+			next_voice = 0
+			# (start frame, end frame, audio, gain) of the samples playing in the current block
+			active_voices = []
+			for block_start in range(0, end_frame, RENDER_BLOCK_FRAMES):
+				block_end = min(block_start + RENDER_BLOCK_FRAMES, end_frame)
+				block = numpy.zeros((block_end - block_start, RENDER_CHANNELS), dtype=numpy.float32)
+				# start the samples beginning in this block
+				while next_voice < len(voice_starts) and voice_starts[next_voice] < block_end:
+					keysound_id = voice_keysounds[next_voice]
+					audio = decoded_keysounds.get(keysound_files[keysound_id])
+					voice_start = voice_starts[next_voice]
+					voice_end = voice_start + min(voice_lengths[next_voice], len(audio))
+					active_voices.append((voice_start, voice_end, audio, gains[keysound_id]))
+					next_voice += 1
+				# mix, keeping the samples that play past this block
+				playing_voices = []
+				for voice_start, voice_end, audio, gain in active_voices:
+					mix_start = max(voice_start, block_start)
+					mix_end = min(voice_end, block_end)
+					if mix_end > mix_start:
+						block[mix_start - block_start:mix_end - block_start] += audio[mix_start - voice_start:mix_end - voice_start] * gain
+					if voice_end > block_end:
+						playing_voices.append((voice_start, voice_end, audio, gain))
+				active_voices = playing_voices
+				writer.write(block)
+			writer.close()
+			os.replace(temp_file, render_file)
+		except:
+			writer.abort()
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+			raise
+		elapsed = time.perf_counter() - start_time
+		realtime = end_frame / frame_rate / elapsed if elapsed > 0 else 0
+		self.log("Rendered {:.1f}s of audio, {} samples in {:.3f}s ({:.0f}x realtime)".format(end_frame / frame_rate, len(voice_starts), elapsed, realtime))
+
+	# generate the text of the rpp in chunks
+	# keysound paths are relative to out_dir, or absolute if out_dir is None
+	def generate_rpp(self, out_dir):
+		self.rpp_items = 0
+		header = ["<REAPER_PROJECT\n",
+				"TEMPO {} 4 4\n".format(self.chart_bpm),
+				"MASTERTRACKVIEW 1 0.6667 0.5 0.5 0 0 0 0 0 0\n"]
+		header.append("MASTER_VOLUME {} 0 -1 -1 1\n".format(self.get_master_volume()))
+		header.append("VIDEO_CONFIG 0 0 256\n")
+		header.append("PANMODE 3\n")
+		header.append("VZOOMEX 0 0\n")
 		# create tempomap - bpms & time signatures
-		if len(bpm_positions) or len(measurelentime_dict) > 1:
-			rpp_out.write("<TEMPOENVEX\n")
+		if len(self.bpm_positions) or len(self.measurelentime_dict) > 1:
+			header.append("<TEMPOENVEX\n")
 			# bpm markers
-			for bpm_pos in bpm_positions:
-				bpmtime = bpmtime_dict[bpm_pos]
-				bpm = bpm_dict[bpm_pos]
-				rpp_out.write("PT {} {} 1\n".format(bpmtime, bpm))
+			for bpm_pos in self.bpm_positions:
+				bpmtime = self.bpmtime_dict[bpm_pos]
+				bpm = self.bpm_dict[bpm_pos]
+				header.append("PT {} {} 1\n".format(bpmtime, bpm))
 			# time signature markers
-			for measurelen_pos in measurelentime_dict:
-				measurelentime = measurelentime_dict[measurelen_pos]
-				measurelen = measurelen_dict[measurelen_pos]
+			for measurelen_pos in self.measurelentime_dict:
+				measurelentime = self.measurelentime_dict[measurelen_pos]
+				measurelen = self.measurelen_dict[measurelen_pos]
 				# convert measure length into time signature fraction
 				ts_num, ts_den = measurelen.as_integer_ratio()
 				# ensure denominator is a multiple of 4
@@ -642,22 +2201,28 @@ def parse_keysounds(chart_file, out_file):
 					ts_num *= den4_factor
 					ts_den *= den4_factor
 				if ts_num > 256 or ts_den > 256:
-					print("Warning: Ignoring unusual time signature {}/{} at beat {}".format(ts_num, ts_den, measurelen_pos))
+					self.warn("Ignoring unusual time signature {}/{} at beat {}".format(ts_num, ts_den, measurelen_pos))
 				else:
-					rpp_out.write("PT {} 0 1 {} 0 3\n".format(measurelentime, ts_den*65536 + ts_num))
-			rpp_out.write(">\n")
-		
+					header.append("PT {} 0 1 {} 0 3\n".format(measurelentime, ts_den*65536 + ts_num))
+			header.append(">\n")
+		yield "".join(header)
+
 		# group keysounds with the same prefix
 		keysound_group_re = re.compile(r"^([A-Za-z\-]+).*$")
 		keysound_in_group = False
-		
+
 		# create keysound tracks
-		for i in range(len(keysound_indices)):
-			keysound_index = keysound_indices[i]
-			if keysound_index in sample_dict:
+		for i in range(len(self.keysound_indices)):
+			keysound_index = self.keysound_indices[i]
+			if keysound_index in self.sample_dict:
 				# create a track for each keysound
-				keysound_name, keysound_ext = os.path.splitext(keysound_dict[keysound_index])
-				
+				keysound_name, keysound_ext = os.path.splitext(self.keysound_dict[keysound_index])
+				if keysound_index in self.chunked_oggs:
+					keysound_rpp_path = self.chunked_oggs[keysound_index]
+					keysound_ext = OGG_EXT
+				else:
+					keysound_rpp_path = self.get_rpp_keysound_path(self.keysound_dict[keysound_index], out_dir)
+
 				# should we make a new track group or end an existing one?
 				keysound_new_group = False
 				keysound_end_group = False
@@ -668,14 +2233,14 @@ def parse_keysounds(chart_file, out_file):
 					# lookahead to next keysound
 					keysound_next_group = None
 					j = i + 1
-					while j < len(keysound_indices):
-						keysound_next_index = keysound_indices[j]
-						if keysound_next_index in sample_dict:
-							keysound_next_name, keysound_next_ext = os.path.splitext(keysound_dict[keysound_next_index])
+					while j < len(self.keysound_indices):
+						keysound_next_index = self.keysound_indices[j]
+						if keysound_next_index in self.sample_dict:
+							keysound_next_name, keysound_next_ext = os.path.splitext(self.keysound_dict[keysound_next_index])
 							keysound_next_group_match = keysound_group_re.match(keysound_next_name)
 							if keysound_next_group_match != None:
 								keysound_next_group = keysound_next_group_match.group(1)
-							j = len(keysound_indices)
+							j = len(self.keysound_indices)
 						else:
 							j += 1
 					if not keysound_in_group and keysound_group == keysound_next_group:
@@ -687,90 +2252,677 @@ def parse_keysounds(chart_file, out_file):
 				else:
 					# a keysound not matching the prefix pattern shouldn't ever be in a group
 					if keysound_in_group:
-						print("ERROR: Keysound {} should not have been in a group".format(keysound_name))
-						usage()
-				
-				rpp_out.write("<TRACK\n")
-				rpp_out.write('NAME "{}"\n'.format(keysound_name))
-				if parsing_mode == MODE_BMS:
-					rpp_out.write("VOLPAN 1 0 -1 -1 1\n")
-				elif parsing_mode == MODE_DTX:
-					if keysound_index in keysoundvol_dict:
-						vol = keysoundvol_dict[keysound_index]
-					else:
-						vol = 1.0
-					if keysound_index in keysoundpan_dict:
-						pan = keysoundpan_dict[keysound_index]
-					else:
-						pan = 0.0
-					rpp_out.write("VOLPAN {} {} -1 -1 1\n".format(vol, pan))
+						raise ConversionError("Keysound {} should not have been in a group".format(keysound_name))
+
+				track = ["<TRACK\n", 'NAME "{}"\n'.format(keysound_name)]
+				if self.parsing_mode == MODE_BMS:
+					track.append("VOLPAN 1 0 -1 -1 1\n")
+				elif self.parsing_mode == MODE_DTX:
+					track.append("VOLPAN {} {} -1 -1 1\n".format(*self.get_track_volpan(keysound_index)))
 				if keysound_new_group:
-					rpp_out.write("ISBUS 1 1\n")
+					track.append("ISBUS 1 1\n")
 				elif keysound_end_group:
-					rpp_out.write("ISBUS 2 -1\n")
+					track.append("ISBUS 2 -1\n")
 				else:
-					rpp_out.write("ISBUS 0 0\n")
-				# sort samples by position
-				sample_array = sample_dict[keysound_index]
-				sample_array.sort(key=sample_pos_sort_key)
-				for s in range(len(sample_array)):
-					sample = sample_array[s]
-					if parsing_mode == MODE_BMS:
-						# cut the lengths of BMS samples that overlap themselves
-						if s + 1 < len(sample_array):
-							next_sample = sample_array[s+1]
-							if sample["pos"] + sample["length"] > next_sample["pos"]:
-								sample["length"] = next_sample["pos"] - sample["pos"]
-					if sample["length"] > 0:
-						# add a keysound sample to the track
-						rpp_out.write("<ITEM\n")
-						rpp_out.write("POSITION {}\n".format(sample["pos"]))
-						rpp_out.write("LENGTH {}\n".format(sample["length"]))
-						rpp_out.write("LOOP 0\n")
-						rpp_out.write("NAME {}\n".format(keysound_dict[keysound_index]))
-						# TODO per-sample volume
-						# if "volume" in sample:
-							# rpp_out.write("VOLPAN {} 0 1 -1\n".format(sample["volume"]))
-						if keysound_ext.lower() == WAV_EXT:
-							rpp_out.write("<SOURCE WAVE\n")
-						elif keysound_ext.lower() == OGG_EXT:
-							rpp_out.write("<SOURCE VORBIS\n")
-						elif keysound_ext.lower() == MP3_EXT:
-							rpp_out.write("<SOURCE MP3\n")
-						else:
-							# unknown audio type
-							rpp_out.write("<SOURCE\n")
-						rpp_out.write('FILE "{}"\n'.format(keysound_dict[keysound_index]))
-						rpp_out.write(">\n")
-						rpp_out.write(">\n")
-				rpp_out.write(">\n")
-		rpp_out.write(">\n")
-		
-	print("Done, output to {}".format(out_file))
+					track.append("ISBUS 0 0\n")
+
+				# everything after the position & length is the same for every item of the track
+				# TODO per-sample volume
+				item_tail = ["LOOP 0\n", "NAME {}\n".format(self.keysound_dict[keysound_index])]
+				if keysound_ext.lower() == WAV_EXT:
+					item_tail.append("<SOURCE WAVE\n")
+				elif keysound_ext.lower() == OGG_EXT:
+					item_tail.append("<SOURCE VORBIS\n")
+				elif keysound_ext.lower() == MP3_EXT:
+					item_tail.append("<SOURCE MP3\n")
+				else:
+					# unknown audio type
+					item_tail.append("<SOURCE\n")
+				item_tail.append('FILE "{}"\n'.format(keysound_rpp_path))
+				item_tail.append(">\n>\n")
+				item_tail = "".join(item_tail)
+
+				# samples in timeline order
+				samples = self.keysound_timelines[self.keysound_ids[keysound_index]]
+				if self.keep_track_items:
+					items_key = (item_tail,
+						array("d", [self.sample_pos[sample] for sample in samples]).tobytes(),
+						array("d", [self.sample_length[sample] for sample in samples]).tobytes())
+					if keysound_index in self.track_items and self.track_items[keysound_index][0] == items_key:
+						items_text, num_items = self.track_items[keysound_index][1:]
+					else:
+						items_text, num_items = self.format_items(samples, item_tail)
+						self.track_items[keysound_index] = (items_key, items_text, num_items)
+				else:
+					items_text, num_items = self.format_items(samples, item_tail)
+				self.rpp_items += num_items
+				track.append(items_text)
+				track.append(">\n")
+				yield "".join(track)
+		yield ">\n"
+
+
+# format a profile as a human readable table
+def format_profile_table(profile):
+	lines = ["{:<10}{:>12}{:>12}".format("phase", "wall (s)", "cpu (s)")]
+	for name in profile["phases"]:
+		phase = profile["phases"][name]
+		lines.append("{:<10}{:>12.4f}{:>12.4f}".format(name, phase["wall"], phase["cpu"]))
+	lines.append("{:<10}{:>12.4f}{:>12.4f}".format("total", profile["wall"], profile["cpu"]))
+	lines.append("")
+	lines.append("{:<16}{:>12}".format("counter", "value"))
+	for name in profile["counters"]:
+		lines.append("{:<16}{:>12}".format(name, profile["counters"][name]))
+	return "\n".join(lines)
+
+def open_keysound_cache():
+	import sqlite3
+	try:
+		return KeysoundCache(os.path.join(get_cache_dir(), KEYSOUND_CACHE_FILE))
+	except (OSError, sqlite3.Error) as e:
+		print("Warning: could not open keysound cache, {}".format(e))
+	return None
+
+# batch conversion report, written to the batch directory by default
+BATCH_REPORT_FILE = "bms_to_rpp_report.txt"
+# number of slowest charts of a batch shown by --profile
+BATCH_PROFILE_CHARTS = 10
+
+# find every chart in a directory tree
+def find_charts(batch_dir):
+	chart_files = []
+	for dir_path, dir_names, filenames in os.walk(batch_dir):
+		dir_names.sort()
+		for filename in sorted(filenames):
+			chart_ext = os.path.splitext(filename)[1].lower()
+			if chart_ext in BMS_EXTS or chart_ext == DTX_EXT:
+				chart_files.append(os.path.join(dir_path, filename))
+	return chart_files
+
+# check if an rpp is newer than its chart & all of the chart's keysounds
+def is_up_to_date(chart_file, out_file, keysound_exts=KEYSOUND_EXTS):
+	try:
+		out_mtime = os.stat(out_file).st_mtime_ns
+	except OSError:
+		return False
+	if os.stat(chart_file).st_mtime_ns >= out_mtime:
+		return False
+	chart_dir = os.path.dirname(chart_file)
+	keysound_index = get_keysound_index(chart_dir)
+	with open(chart_file, "r", encoding="shift_jis", errors="replace") as chart:
+		for line in chart:
+			re_match = LINE_RE.match(line)
+			if re_match != None and re_match.group("header") == "WAV":
+				keysound_filename = keysound_index.find(re_match.group("header_value"), keysound_exts)
+				if keysound_filename != None and os.stat(os.path.join(chart_dir, keysound_filename)).st_mtime_ns >= out_mtime:
+					return False
+	return True
+
+# converter of a batch worker process, with its own cache connection
+batch_converter = None
+
+def init_batch_worker(use_cache, keysound_exts, probe_unused):
+	global batch_converter
+	keysound_cache = open_keysound_cache() if use_cache else None
+	chart_cache_dir = get_chart_cache_dir() if use_cache else None
+	# charts are converted in parallel, keysounds within a chart are not
+	batch_converter = ChartConverter(keysound_cache, probe_jobs=1, verbose=False, keysound_exts=keysound_exts, probe_unused=probe_unused,
+		chart_cache_dir=chart_cache_dir)
+
+# start a pool of batch worker processes
+# multiprocessing is only imported for --batch & --serve
+def start_batch_pool(jobs, use_cache, keysound_exts, probe_unused):
+	from concurrent.futures import ProcessPoolExecutor
+	return ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker, initargs=(use_cache, keysound_exts, probe_unused))
+
+# convert one chart of a batch, with its output hidden
+# returns the status ("converted", "skipped" or "failed"), any warnings or errors
+# & the profile of a converted chart
+def batch_convert_chart(chart_file, force):
+	out_file = os.path.splitext(chart_file)[0] + RPP_EXT
+	try:
+		if not force and is_up_to_date(chart_file, out_file, batch_converter.keysound_exts):
+			return "skipped", [], None
+		batch_converter.convert(chart_file, out_file)
+	except ConversionError as e:
+		return "failed", batch_converter.warnings + ["ERROR: {}".format(e)], None
+	except Exception as e:
+		return "failed", batch_converter.warnings + ["ERROR: {}: {}".format(type(e).__name__, e)], None
+	return "converted", list(batch_converter.warnings), batch_converter.get_profile()
+
+# convert every chart in a directory tree on a process pool & write a report
+# profile_format prints the profiles of the converted charts, "table" or "json"
+def convert_batch(batch_dir, jobs, use_cache, force, report_file=None, profile_format=None, keysound_exts=KEYSOUND_EXTS, probe_unused=False):
+	batch_dir = os.path.abspath(batch_dir)
+	if report_file == None:
+		report_file = os.path.join(batch_dir, BATCH_REPORT_FILE)
+	chart_files = find_charts(batch_dir)
+	print("Converting {} charts in {}...".format(len(chart_files), batch_dir))
+
+	results = []
+	profiles = []
+	with start_batch_pool(jobs, use_cache, keysound_exts, probe_unused) as pool:
+		futures = [pool.submit(batch_convert_chart, chart_file, force) for chart_file in chart_files]
+		for chart_file, future in zip(chart_files, futures):
+			try:
+				status, messages, profile = future.result()
+			except Exception as e:
+				status, messages, profile = "failed", ["ERROR: {}: {}".format(type(e).__name__, e)], None
+			print("{}: {}".format(status, os.path.relpath(chart_file, batch_dir)))
+			results.append((chart_file, status, messages))
+			if profile != None:
+				profile["chart"] = os.path.relpath(chart_file, batch_dir)
+				profiles.append(profile)
+
+	num_converted = sum(1 for result in results if result[1] == "converted")
+	num_skipped = sum(1 for result in results if result[1] == "skipped")
+	num_failed = sum(1 for result in results if result[1] == "failed")
+	num_warned = sum(1 for result in results if result[1] == "converted" and len(result[2]) != 0)
+	summary = "Converted: {}, with warnings: {}, skipped (up to date): {}, failed: {}".format(num_converted, num_warned, num_skipped, num_failed)
+	with open(report_file, "w", encoding="utf-8") as report:
+		report.write("BMS to RPP {} batch report\n".format(VERSION))
+		report.write("Directory: {}\n".format(batch_dir))
+		report.write(summary + "\n")
+		for heading, status in (("Failed", "failed"), ("Converted with warnings", "converted")):
+			lines = []
+			for chart_file, result_status, messages in results:
+				if result_status == status and len(messages) != 0:
+					lines.append(os.path.relpath(chart_file, batch_dir))
+					for message in messages:
+						lines += ["    " + message_line for message_line in message.split("\n")]
+			if len(lines) != 0:
+				report.write("\n{}:\n".format(heading))
+				report.write("\n".join(lines) + "\n")
+	print(summary)
+	print("Report written to {}".format(report_file))
+
+	if profile_format == "json":
+		print(json.dumps(profiles, indent=2))
+	elif profile_format == "table":
+		profiles.sort(key=lambda profile: profile["wall"], reverse=True)
+		for profile in profiles[:BATCH_PROFILE_CHARTS]:
+			print("\n{}".format(profile["chart"]))
+			print(format_profile_table(profile))
+	return num_failed == 0
+
+# print the profile of the last conversion, if a --profile format was given
+def print_profile(converter, profile_format):
+	if profile_format == "json":
+		print(json.dumps(converter.get_profile(), indent=2), file=converter.log_file)
+	elif profile_format == "table":
+		print(format_profile_table(converter.get_profile()), file=converter.log_file)
+
+# convert a chart, then convert it again whenever it changes until interrupted
+# keysound lengths & parsed channels are kept, so only edited measures are processed again
+def watch_chart(converter, chart_file, out_file, profile_format=None, render_file=None):
+	last_stat = None
+	print("Watching {}, press Ctrl+C to stop".format(chart_file), file=converter.log_file)
+	try:
+		while True:
+			try:
+				stat = os.stat(chart_file)
+				chart_stat = (stat.st_mtime_ns, stat.st_size)
+			except OSError:
+				# the chart may be missing for a moment while an editor saves it
+				chart_stat = None
+			if chart_stat != None and chart_stat != last_stat:
+				last_stat = chart_stat
+				start_time = time.perf_counter()
+				try:
+					converter.reconvert(chart_file, out_file, render_file)
+					print("Converted in {:.3f}s".format(time.perf_counter() - start_time), file=converter.log_file)
+					print_profile(converter, profile_format)
+				except ConversionError as e:
+					# keep watching, the chart may be fixed by the next save
+					print("ERROR: {}".format(e), file=converter.log_file)
+				except Exception as e:
+					print("ERROR: {}: {}".format(type(e).__name__, e), file=converter.log_file)
+			time.sleep(WATCH_INTERVAL)
+	except KeyboardInterrupt:
+		pass
+
+# default --serve host, only local clients can submit jobs
+SERVE_HOST = "127.0.0.1"
+# finished jobs kept for GET /jobs/<id>, older ones are forgotten
+SERVE_MAX_JOBS = 1000
+# latest finished jobs used for the latency metrics
+SERVE_LATENCY_JOBS = 100
+# largest request body accepted
+SERVE_MAX_REQUEST_BYTES = 1 << 16
+
+# convert one chart of a --serve job in a worker process
+# the worker's converter keeps its keysound memo, decoded keysounds & cache connection between jobs
+# returns the status ("converted" or "failed"), any warnings or errors & the profile of a converted chart
+def serve_convert_chart(chart_file, out_file, render_file, probe_unused):
+	batch_converter.probe_unused = probe_unused
+	try:
+		batch_converter.convert(chart_file, out_file, render_file)
+	except ConversionError as e:
+		return "failed", batch_converter.warnings + ["ERROR: {}".format(e)], None
+	except Exception as e:
+		return "failed", batch_converter.warnings + ["ERROR: {}: {}".format(type(e).__name__, e)], None
+	return "converted", list(batch_converter.warnings), batch_converter.get_profile()
+
+# conversion jobs of --serve, queued & run on a process pool
+# one dispatcher thread per worker process takes jobs off the queue, so queued jobs haven't started yet
+# jobs are dicts ready to be sent as json, finished ones are kept until there are SERVE_MAX_JOBS
+class ConversionJobs:
+	def __init__(self, jobs, use_cache, keysound_exts, probe_unused):
+		self.num_workers = jobs
+		self.pool_args = (use_cache, keysound_exts, probe_unused)
+		self.probe_unused = probe_unused
+		self.pool = start_batch_pool(jobs, *self.pool_args)
+		self.queue = queue.Queue()
+		self.lock = threading.Lock()
+		self.jobs = OrderedDict()
+		# set when a job is finished, for clients waiting on it
+		self.job_events = {}
+		self.next_id = 1
+		self.num_running = 0
+		self.num_converted = 0
+		self.num_failed = 0
+		self.latencies = []
+		self.start_time = time.time()
+		for i in range(jobs):
+			threading.Thread(target=self.dispatch, daemon=True).start()
+
+	# queue a job from a request, returns the job or raises ValueError for a bad request
+	# the chart is relative to the working directory of the server, the output & render files to the chart
+	def submit(self, request):
+		if not isinstance(request, dict) or not isinstance(request.get("chart"), str):
+			raise ValueError("missing chart")
+		chart_file = os.path.abspath(request["chart"])
+		chart_ext = os.path.splitext(chart_file)[1].lower()
+		if chart_ext not in BMS_EXTS and chart_ext != DTX_EXT:
+			raise ValueError("unknown chart file type: {}".format(chart_ext))
+		chart_dir = os.path.dirname(chart_file)
+		out_file = request.get("out")
+		if out_file != None:
+			if not isinstance(out_file, str) or out_file == RPP_STDOUT:
+				raise ValueError("invalid out")
+			out_file = os.path.join(chart_dir, out_file)
+		render_file = request.get("render")
+		if render_file != None:
+			if not isinstance(render_file, str) or os.path.splitext(render_file)[1].lower() not in RENDER_EXTS:
+				raise ValueError("render must be a {} file".format(" or ".join(RENDER_EXTS)))
+			render_file = os.path.join(chart_dir, render_file)
+		job = {
+			"chart": chart_file,
+			"out": out_file,
+			"render": render_file,
+			"probe_unused": bool(request.get("probe_unused", self.probe_unused)),
+			"status": "queued",
+			"messages": [],
+			"profile": None,
+			"submitted": time.time(),
+			"queue_seconds": None,
+			"run_seconds": None,
+		}
+		with self.lock:
+			job["id"] = self.next_id
+			self.next_id += 1
+			self.jobs[job["id"]] = job
+			self.job_events[job["id"]] = threading.Event()
+			self.forget_jobs()
+		self.queue.put(job)
+		return job
+
+	# forget the oldest finished jobs once there are too many
+	def forget_jobs(self):
+		finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("converted", "failed")]
+		for job_id in finished[:max(0, len(self.jobs) - SERVE_MAX_JOBS)]:
+			del self.jobs[job_id]
+			del self.job_events[job_id]
+
+	# run queued jobs one at a time, until the server exits
+	def dispatch(self):
+		from concurrent.futures.process import BrokenProcessPool
+		while True:
+			job = self.queue.get()
+			start = time.time()
+			with self.lock:
+				job["status"] = "running"
+				job["queue_seconds"] = start - job["submitted"]
+				self.num_running += 1
+				pool = self.pool
+			try:
+				status, messages, profile = pool.submit(serve_convert_chart, job["chart"], job["out"],
+					job["render"], job["probe_unused"]).result()
+			except BrokenProcessPool as e:
+				# a worker died, start a new pool for the next jobs
+				status, messages, profile = "failed", ["ERROR: {}: {}".format(type(e).__name__, e)], None
+				with self.lock:
+					if self.pool == pool:
+						self.pool = start_batch_pool(self.num_workers, *self.pool_args)
+			except Exception as e:
+				status, messages, profile = "failed", ["ERROR: {}: {}".format(type(e).__name__, e)], None
+			with self.lock:
+				job["status"] = status
+				job["messages"] = messages
+				job["profile"] = profile
+				job["run_seconds"] = time.time() - start
+				self.num_running -= 1
+				if status == "converted":
+					self.num_converted += 1
+				else:
+					self.num_failed += 1
+				self.latencies.append(job["queue_seconds"] + job["run_seconds"])
+				del self.latencies[:-SERVE_LATENCY_JOBS]
+				event = self.job_events.get(job["id"])
+			if event != None:
+				event.set()
+
+	# get a job by id, waiting until it's finished if wait is set, or None
+	def get(self, job_id, wait=False):
+		with self.lock:
+			job = self.jobs.get(job_id)
+			event = self.job_events.get(job_id)
+		if job != None and wait:
+			event.wait()
+		return job
+
+	def list_jobs(self):
+		with self.lock:
+			return [{"id": job["id"], "chart": job["chart"], "status": job["status"]} for job in self.jobs.values()]
+
+	# queue depth, job counts & latency of the latest finished jobs, from submission to the end of the conversion
+	def get_metrics(self):
+		with self.lock:
+			latencies = sorted(self.latencies)
+			recent_jobs = [{"id": job["id"], "chart": job["chart"], "status": job["status"],
+				"queue_seconds": job["queue_seconds"], "run_seconds": job["run_seconds"]}
+				for job in self.jobs.values() if job["run_seconds"] != None][-SERVE_LATENCY_JOBS:]
+			metrics = {
+				"uptime_seconds": time.time() - self.start_time,
+				"workers": self.num_workers,
+				"queue_depth": self.queue.qsize(),
+				"running": self.num_running,
+				"converted": self.num_converted,
+				"failed": self.num_failed,
+			}
+		if len(latencies) > 0:
+			import statistics
+			metrics["latency_seconds"] = {
+				"count": len(latencies),
+				"mean": sum(latencies) / len(latencies),
+				"p50": statistics.median(latencies),
+				"p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+				"max": latencies[-1],
+			}
+		metrics["jobs"] = recent_jobs
+		return metrics
+
+	# wait for the running jobs, queued jobs are dropped
+	def close(self):
+		self.pool.shutdown()
+
+# http api of --serve, all requests & responses are json
+# POST /jobs                 queue a job: {"chart": ..., "out": ..., "render": ..., "probe_unused": ..., "wait": ...}
+#                            with "wait": true, respond once the job is finished
+# GET /jobs                  list the jobs
+# GET /jobs/<id>[?wait=1]    get a job & its result
+# GET /metrics               queue depth, job counts & latencies
+# mixed into http.server's request handler by create_server(), as http.server is slow to import
+class ServeRequestHandler:
+	server_version = "bms_to_rpp/" + VERSION
+
+	def send_json(self, code, value):
+		body = json.dumps(value, indent=2).encode("utf-8")
+		self.send_response(code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_error_json(self, code, message):
+		self.send_json(code, {"error": message})
+
+	def do_GET(self):
+		jobs = self.server.conversion_jobs
+		path, _, query = self.path.partition("?")
+		path = path.rstrip("/")
+		if path == "/metrics":
+			self.send_json(200, jobs.get_metrics())
+		elif path == "/jobs":
+			self.send_json(200, jobs.list_jobs())
+		elif path.startswith("/jobs/"):
+			try:
+				job_id = int(path[len("/jobs/"):])
+			except ValueError:
+				return self.send_error_json(404, "no such job")
+			job = jobs.get(job_id, "wait=1" in query.split("&"))
+			if job == None:
+				return self.send_error_json(404, "no such job")
+			self.send_json(200, job)
+		else:
+			self.send_error_json(404, "not found")
+
+	def do_POST(self):
+		jobs = self.server.conversion_jobs
+		if self.path.rstrip("/") != "/jobs":
+			return self.send_error_json(404, "not found")
+		# the body is read by its length, so a request without a valid one is rejected before reading
+		if self.headers.get("Content-Length") == None:
+			return self.send_error_json(411, "missing Content-Length")
+		try:
+			length = int(self.headers["Content-Length"])
+		except ValueError:
+			length = -1
+		if length < 0:
+			return self.send_error_json(400, "invalid Content-Length")
+		if length > SERVE_MAX_REQUEST_BYTES:
+			return self.send_error_json(400, "request larger than {} bytes".format(SERVE_MAX_REQUEST_BYTES))
+		try:
+			request = json.loads(self.rfile.read(length).decode("utf-8"))
+			job = jobs.submit(request)
+		except ValueError as e:
+			return self.send_error_json(400, str(e))
+		if request.get("wait"):
+			job = jobs.get(job["id"], True)
+		self.send_json(202 if job["status"] in ("queued", "running") else 200, job)
+
+	# unix socket clients have no address
+	def address_string(self):
+		if isinstance(self.client_address, tuple):
+			return self.client_address[0]
+		return "unix"
+
+	def log_message(self, format, *args):
+		print("{} {}".format(self.address_string(), format % args))
+
+# create the --serve server, on host:port, a port of SERVE_HOST, or a unix socket path
+def create_server(address):
+	import socket
+	import socketserver
+	import http.server
+	class RequestHandler(ServeRequestHandler, http.server.BaseHTTPRequestHandler):
+		pass
+	host, _, port = address.rpartition(":")
+	if port.isdigit():
+		server = http.server.ThreadingHTTPServer((host if host != "" else SERVE_HOST, int(port)), RequestHandler)
+		server.daemon_threads = True
+		return server, "http://{}:{}".format(*server.server_address[:2])
+	if not hasattr(socket, "AF_UNIX"):
+		raise ConversionError("unix sockets aren't supported here, give a port")
+	class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+		daemon_threads = True
+	# remove the socket of a server that didn't exit cleanly
+	try:
+		if stat.S_ISSOCK(os.stat(address).st_mode):
+			os.remove(address)
+	except OSError:
+		pass
+	return UnixHTTPServer(address, RequestHandler), "unix socket {}".format(address)
+
+# run the conversion server until interrupted
+def serve(address, jobs, use_cache, keysound_exts, probe_unused):
+	server, description = create_server(address)
+	server.conversion_jobs = ConversionJobs(jobs, use_cache, keysound_exts, probe_unused)
+	print("Serving on {} with {} workers, press Ctrl+C to stop".format(description, jobs))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		server.conversion_jobs.close()
+		if not isinstance(server.server_address, tuple):
+			try:
+				os.remove(server.server_address)
+			except OSError:
+				pass
+
+# get the value of an option, either --option=value or --option value
+def get_option_value(arg, argv):
+	if "=" in arg:
+		return arg.split("=", 1)[1]
+	if len(argv) > 0:
+		return argv.pop(0)
+	print("ERROR: Missing value for {}".format(arg))
+	usage()
 
 def main():
-	global parsing_mode
-	if len(sys.argv) < 2:
+	keysound_cache = None
+	probe_jobs = os.cpu_count() or 1
+	use_cache = True
+	clear_cache = False
+	batch_dir = None
+	report_file = None
+	force = False
+	profile_format = None
+	watch = False
+	keysound_exts = KEYSOUND_EXTS
+	render_file = None
+	probe_unused = False
+	serve_address = None
+	args = []
+	argv = sys.argv[1:]
+	while len(argv) > 0:
+		arg = argv.pop(0)
+		option = arg.split("=", 1)[0]
+		if option == "--jobs":
+			value = get_option_value(arg, argv)
+			try:
+				probe_jobs = int(value)
+			except ValueError:
+				probe_jobs = 0
+			if probe_jobs < 1:
+				print("ERROR: Invalid --jobs value {}".format(value))
+				usage()
+		elif option == "--exts":
+			value = get_option_value(arg, argv)
+			keysound_exts = tuple("." + ext.strip().lstrip(".").lower() for ext in value.split(",") if ext.strip().lstrip(".") != "")
+			if len(keysound_exts) == 0:
+				print("ERROR: Invalid --exts value {}".format(value))
+				usage()
+		elif option == "--batch":
+			batch_dir = get_option_value(arg, argv)
+		elif option == "--report":
+			report_file = os.path.abspath(get_option_value(arg, argv))
+		elif arg == "--force":
+			force = True
+		elif arg == "--watch":
+			watch = True
+		elif option == "--serve":
+			serve_address = get_option_value(arg, argv)
+		elif arg == "--probe-unused":
+			probe_unused = True
+		elif option == "--render":
+			render_file = get_option_value(arg, argv)
+			if os.path.splitext(render_file)[1].lower() not in RENDER_EXTS:
+				print("ERROR: --render file must be a {} file".format(" or ".join(RENDER_EXTS)))
+				usage()
+		elif option == "--profile":
+			profile_format = arg.split("=", 1)[1] if "=" in arg else "table"
+			if profile_format not in PROFILE_FORMATS:
+				print("ERROR: Invalid --profile format {}".format(profile_format))
+				usage()
+		elif arg == "--no-cache":
+			use_cache = False
+		elif arg == "--clear-cache":
+			clear_cache = True
+		elif arg.startswith("--"):
+			print("ERROR: Unknown option {}".format(arg))
+			usage()
+		else:
+			args.append(arg)
+
+	if use_cache or clear_cache:
+		keysound_cache = open_keysound_cache()
+		if keysound_cache != None:
+			if clear_cache:
+				keysound_cache.clear()
+				evict_chart_cache(get_chart_cache_dir(), 0)
+				print("Cleared keysound & compiled chart caches")
+			if not use_cache or batch_dir != None or serve_address != None:
+				# batch & server workers open their own connections
+				keysound_cache.close()
+				keysound_cache = None
+
+	if serve_address != None:
+		if batch_dir != None or render_file != None or watch:
+			print("ERROR: --serve can't be used with --batch, --render or --watch")
+			usage()
+		try:
+			serve(serve_address, probe_jobs, use_cache, keysound_exts, probe_unused)
+		except (OSError, ConversionError) as e:
+			print("ERROR: Could not start server, {}".format(e))
+			sys.exit(1)
+		# evict old entries after serving
+		if use_cache:
+			keysound_cache = open_keysound_cache()
+			if keysound_cache != None:
+				keysound_cache.close()
+			evict_chart_cache(get_chart_cache_dir())
+		return
+
+	if batch_dir != None:
+		if render_file != None:
+			print("ERROR: --render can't be used with --batch")
+			usage()
+		if not os.path.isdir(batch_dir):
+			print("ERROR: Not a directory: {}".format(batch_dir))
+			usage()
+		success = convert_batch(batch_dir, probe_jobs, use_cache, force, report_file, profile_format, keysound_exts, probe_unused)
+		# evict old entries after the batch
+		if use_cache:
+			keysound_cache = open_keysound_cache()
+			if keysound_cache != None:
+				keysound_cache.close()
+			evict_chart_cache(get_chart_cache_dir())
+		sys.exit(0 if success else 1)
+
+	if len(args) < 1:
+		if clear_cache:
+			return
 		usage()
 	else:
-		chart_file = sys.argv[1]
-		chart_filename, chart_ext = os.path.splitext(chart_file)
-		if chart_ext in BMS_EXTS:
-			parsing_mode = MODE_BMS
-		elif chart_ext == DTX_EXT:
-			parsing_mode = MODE_DTX
-		else:
-			print("ERROR: Unknown chart file type: {}".format(chart_ext))
+		chart_file = args[0]
+		out_file = None
+		if len(args) > 1 and args[1] == RPP_STDOUT:
+			out_file = RPP_STDOUT
+		elif len(args) > 1:
+			# relative to the chart's directory
+			out_file = os.path.join(os.path.dirname(os.path.abspath(chart_file)), args[1])
+		if render_file != None:
+			render_file = os.path.join(os.path.dirname(os.path.abspath(chart_file)), render_file)
+		chart_cache_dir = get_chart_cache_dir() if use_cache else None
+		converter = ChartConverter(keysound_cache, probe_jobs, keep_track_items=watch, keysound_exts=keysound_exts, probe_unused=probe_unused,
+			chart_cache_dir=chart_cache_dir)
+		try:
+			if watch:
+				watch_chart(converter, chart_file, out_file, profile_format, render_file)
+			else:
+				converter.convert(chart_file, out_file, render_file)
+				print_profile(converter, profile_format)
+		except ConversionError as e:
+			print("ERROR: {}".format(e))
 			usage()
-	
-		# change working directory to directory of the input file
-		os.chdir(os.path.dirname(os.path.realpath(chart_file)))
-			
-		if len(sys.argv) > 2:
-			out_file = sys.argv[2]
-		else:
-			out_file = os.path.splitext(os.path.basename(chart_file))[0] + RPP_EXT
-		parse_keysounds(chart_file, out_file)
+		finally:
+			if keysound_cache != None:
+				keysound_cache.close()
+			if chart_cache_dir != None:
+				evict_chart_cache(chart_cache_dir)
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
@@ -1,4 +1,4 @@
-# Chunked OGG Extractor v0.1
+# Chunked OGG Extractor v0.2
 # Copyright (C) 2020 shockdude
 
 # This program is free software: you can redistribute it and/or modify
@@ -18,66 +18,118 @@ import sys
 import os
 import time
 import struct
+import mmap
+import zlib
 
 OGG_EXT = ".ogg"
 OGG_MAGIC = b"OggS"
 DATA_MAGIC = b"data"
 
+# ogg page header: magic, stream structure version, header type flag, absolute granule position,
+# stream serial number, page sequence number, page checksum, number of segments
+# followed by the segment table (one length byte per segment) & the segments
+OGG_PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+OGG_CRC_OFFSET = 22
+# pages with this serial number are padding & get skipped
+SKIPPED_SERIAL = 0xffffffff
+
+# each byte with its bits reversed, for computing the ogg crc with zlib
+BIT_REVERSED_BYTES = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
 def usage():
-	print("Chunked OGG extractor v0.1")
+	print("Chunked OGG extractor v0.2")
 	print('Get a playable OGG out of a "chunked vorbis" WAV')
-	print("Usage: {} file.wav [out.ogg]".format(sys.argv[0]))
+	print("Usage: {} [--check-crc] file.wav [out.ogg]".format(sys.argv[0]))
+	print("  --check-crc  skip pages with a bad checksum, e.g. OggS found by chance in other data")
 	time.sleep(3)
 	sys.exit(1)
 
-def find_ogg(in_filename, out_filename):
+# crc of an ogg page: polynomial 0x04c11db7, not reflected, no initial or final xor,
+# computed with the checksum field zeroed
+# zlib's crc32 is the reflected version of the same polynomial, so run it on bit reversed bytes
+# & reverse the result
+def ogg_page_crc(page):
+	page = bytearray(page)
+	page[OGG_CRC_OFFSET:OGG_CRC_OFFSET+4] = b"\x00\x00\x00\x00"
+	crc = zlib.crc32(page.translate(BIT_REVERSED_BYTES), 0xffffffff) ^ 0xffffffff
+	return int("{:032b}".format(crc)[::-1], 2)
+
+# copy the ogg pages found in data (bytes or mmap) to out_file, skipping padding pages
+# pages are located with find & written as memoryview slices without copying
+# returns the number of pages written, pages skipped, pages with a bad crc & bytes written
+def extract_pages(data, out_file, check_crc=False):
+	data_len = len(data)
+	num_written = 0
+	num_skipped = 0
+	num_bad_crc = 0
+	num_bytes = 0
+	with memoryview(data) as view:
+		pos = data.find(OGG_MAGIC)
+		while pos != -1:
+			if pos + OGG_PAGE_HEADER.size <= data_len:
+				magic, version, header_type, granule, serial, sequence, crc, num_segments = OGG_PAGE_HEADER.unpack_from(data, pos)
+				segment_table_end = pos + OGG_PAGE_HEADER.size + num_segments
+				page_end = segment_table_end + sum(view[pos + OGG_PAGE_HEADER.size:segment_table_end])
+				complete = segment_table_end <= data_len and page_end <= data_len
+				if check_crc and (not complete or ogg_page_crc(view[pos:page_end]) != crc):
+					# not a real page, keep looking right after its magic
+					num_bad_crc += 1
+					pos = data.find(OGG_MAGIC, pos + 1)
+					continue
+				page_end = min(page_end, data_len)
+				skip = serial == SKIPPED_SERIAL
+			else:
+				# truncated page header at the end of the data
+				if check_crc:
+					num_bad_crc += 1
+					break
+				page_end = data_len
+				skip = data[pos+14:pos+18] == b"\xff\xff\xff\xff"
+			if skip:
+				num_skipped += 1
+			else:
+				out_file.write(view[pos:page_end])
+				num_written += 1
+				num_bytes += page_end - pos
+			pos = data.find(OGG_MAGIC, page_end)
+	return num_written, num_skipped, num_bad_crc, num_bytes
+
+def find_ogg(in_filename, out_filename, check_crc=False):
 	print("Writing ogg {} from {}".format(out_filename, in_filename))
+	return extract_file(in_filename, out_filename, check_crc)
+
+# extract the ogg out of a chunked vorbis wav without printing anything
+# returns the same counts as extract_pages
+def extract_file(in_filename, out_filename, check_crc=False):
 	with open(in_filename, "rb") as in_file:
 		with open(out_filename, "wb") as out_file:
-			buf = in_file.read(4)
-			while len(buf) == 4:
-				if buf != OGG_MAGIC:
-					# look for the OggS magic keyword
-					buf = buf[1:] + in_file.read(1)
-				else: # found OggS
-					page_data = buf
-					page_data += in_file.read(2) # stream structure, header type flag
-					page_data += in_file.read(8) # absolute granule position
-					stream_serial_number = in_file.read(4)
-					page_data += stream_serial_number
-					page_data += in_file.read(8) # page sequence number, page checksum
-					
-					# count number of segments in oggs page
-					num_segments_byte = in_file.read(1)
-					page_data += num_segments_byte
-					num_segments = int.from_bytes(num_segments_byte, "little")
-					
-					# count lengths of segments in oggs page
-					total_segments_length = 0
-					for i in range(num_segments):
-						segment_length_byte = in_file.read(1)
-						page_data += segment_length_byte
-						total_segments_length += int.from_bytes(segment_length_byte, "little")
-				
-					page_data += in_file.read(total_segments_length)
-					# skip page if the serial number is all Fs
-					if stream_serial_number != b"\xff\xff\xff\xff":
-						out_file.write(page_data)
-					
-					# move through the loop again
-					buf = in_file.read(4)
+			if os.fstat(in_file.fileno()).st_size == 0:
+				return 0, 0, 0, 0
+			with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				return extract_pages(data, out_file, check_crc)
 
 def main():
-	if len(sys.argv) < 2:
+	args = sys.argv[1:]
+	check_crc = "--check-crc" in args
+	args = [arg for arg in args if arg != "--check-crc"]
+	if len(args) < 1:
 		usage()
 	else:
-		in_filename = sys.argv[1]
+		in_filename = args[0]
 		in_file, in_ext = os.path.splitext(in_filename)
-		if len(sys.argv) > 2:
-			out_filename = sys.argv[2]
+		if len(args) > 1:
+			out_filename = args[1]
 		else:
 			out_filename = os.path.splitext(os.path.basename(in_file))[0] + OGG_EXT
-		find_ogg(in_filename, out_filename)
-		
+		start_time = time.perf_counter()
+		num_written, num_skipped, num_bad_crc, num_bytes = find_ogg(in_filename, out_filename, check_crc)
+		elapsed = time.perf_counter() - start_time
+		in_size = os.path.getsize(in_filename)
+		print("Wrote {} pages ({} bytes), skipped {} padding pages".format(num_written, num_bytes, num_skipped))
+		if check_crc:
+			print("Skipped {} pages with a bad checksum".format(num_bad_crc))
+		if elapsed > 0:
+			print("Scanned {:.1f} MB in {:.3f}s ({:.1f} MB/s)".format(in_size / 1e6, elapsed, in_size / 1e6 / elapsed))
+
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()